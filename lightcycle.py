@@ -1,5 +1,6 @@
 #coding: utf-8
-import random, uuid, math, json, time
+import random, uuid, math, json, time, sys
+from array import array
 from collections import deque
 
 from ui import *
@@ -60,6 +61,58 @@ class Grid(View):
   def touch_ended(self, touch):
     self.game.add_turn(-1 if touch.location[0] < self.width/2 else 1)
 
+class Track():
+  '''
+  Positions of a player, one per tick. Stored as interleaved x and y coordinates in a flat array of 16-bit integers, four bytes per position instead of a tuple object, so long games with many robots stay small and the positions can be walked at C speed.
+  
+  Indexing returns `(x, y)` tuples and slicing returns a list of them, like the list of tuples this replaces. Adding a list of positions returns a new track.
+  '''
+  
+  def __init__(self, positions=()):
+    self.coords = array('h')
+    for pos in positions:
+      self.append(pos)
+      
+  def __len__(self):
+    return len(self.coords) >> 1
+    
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      if step == 1:
+        return list(self.positions(start, stop))
+      return [self[i] for i in range(start, stop, step)]
+    length = len(self)
+    if index < 0:
+      index += length
+    if not 0 <= index < length:
+      raise IndexError('track index out of range')
+    return (self.coords[2*index], self.coords[2*index+1])
+    
+  def __iter__(self):
+    return self.positions()
+    
+  def __add__(self, positions):
+    track = Track()
+    track.coords = self.coords[:]
+    for pos in positions:
+      track.append(pos)
+    return track
+    
+  def append(self, pos):
+    self.coords.append(pos[0])
+    self.coords.append(pos[1])
+    
+  def positions(self, start=0, stop=None):
+    ''' Iterates the positions from `start` up to but not including `stop` as tuples; negative values count from the end. '''
+    length = len(self)
+    stop = length if stop is None else stop
+    if start < 0: start += length
+    if stop < 0: stop += length
+    coords = iter(self.coords[2*max(start, 0):2*max(stop, 0)])
+    return zip(coords, coords)
+    
+
 class Player():
   
   directions = ((0, -1), (1, 0), (0, 1), (-1, 0))
@@ -69,7 +122,7 @@ class Player():
     self.id = id or str(uuid.uuid4())
     color = parse_color(color)
     self.color = tuple([component for component in color[:3]])
-    self.track = []
+    self.track = Track()
     self.direction = 0
     self.committed = False
     
@@ -85,9 +138,9 @@ class Player():
   def get_next_turn(self, game):
     direction = self.direction
     turn = 0
-    tq = game.touch_queues.setdefault(self.id, deque())
-    if len(tq) > 0:
-      turn = tq.popleft()
+    tq = game.touch_queues[self.id]
+    if len(tq) > 0 and tq[0][0] <= game.tick:
+      _, turn = tq.popleft()
       direction += turn
     if direction == 4:
       direction = 0
@@ -119,6 +172,56 @@ class Robot(Player):
       return False
 
 
+class TickBarrier():
+  '''
+  Collects the inputs of remote players for each tick. Call `wait` when a tick is due; `on_complete` is then called with the tick as soon as every expected player has reported it, or when `deadline` seconds have passed, whichever comes first. Players that miss the deadline keep their previous direction.
+  '''
+  
+  def __init__(self, on_complete, deadline=0.05):
+    self.on_complete = on_complete
+    self.deadline = deadline
+    self.reported = {}
+    self.waiting_for = None
+    self.missed = 0
+    
+  def expect(self, ids):
+    self.reported = { id: 0 for id in ids }
+    
+  def forget(self, id):
+    self.reported.pop(id, None)
+    self._check()
+    
+  def restore(self, id):
+    self.reported.setdefault(id, 0)
+    
+  def arrive(self, id, tick):
+    if tick > self.reported.get(id, tick):
+      self.reported[id] = tick
+      self._check()
+      
+  def wait(self, tick):
+    self.waiting_for = tick
+    if not self._check():
+      delay(lambda: self._deadline_passed(tick), self.deadline)
+      
+  def _check(self):
+    tick = self.waiting_for
+    if tick is None or any(reported < tick for reported in self.reported.values()):
+      return False
+    self._release()
+    return True
+    
+  def _deadline_passed(self, tick):
+    if self.waiting_for == tick:
+      self.missed += 1
+      self._release()
+      
+  def _release(self):
+    tick = self.waiting_for
+    self.waiting_for = None
+    self.on_complete(tick)
+
+
 class Game(View):
   '''
   Game object contains information about the players and the state of the game.
@@ -138,9 +241,11 @@ class Game(View):
       def player_lost(self, player):
         # Called with information about an removed player.
         pass
+        
+  `input_deadline` is the time in seconds the game waits for the inputs of remote players when a tick is due.
   '''
   
-  def __init__(self, player, delegate, **kwargs):
+  def __init__(self, player, delegate, input_deadline=0.05, **kwargs):
     super().__init__(**kwargs)
     self.delegate = delegate
     self.players = { player.id: player }
@@ -151,6 +256,10 @@ class Game(View):
     self.derezzes = []
     self.master = True
     self.touch_queues = {}
+    self.tick = 0
+    self.tick_interval = 0.1
+    self.tempo_changes = deque()
+    self.tick_barrier = TickBarrier(self._run_tick, input_deadline)
     
   @property
   def player_list(self):
@@ -169,17 +278,23 @@ class Game(View):
     
   def finalize_players(self):
     self.player_ids = sorted(list(self.players.keys()))
+    self.touch_queues = { id: deque() for id in self.player_ids }
+    self.tick_barrier.expect(self.remote_player_ids())
+    
+  def remote_player_ids(self):
+    ''' Ids of the players whose inputs arrive over the network. '''
+    return []
     
   def all_players_committed(self):
     self.finalize_players()
-    self.touch_queues[self.local_player.id] = deque()
     self.start_time = time.time() + 2.0
     #seed = sum([id.int for id in self.player_ids])
     #random.seed(seed)
     self._callback('all_players_committed')
     
   def add_turn(self, turn):
-    self.touch_queues[self.local_player.id].append(turn)
+    # Turns are tagged with the tick they should be applied on
+    self.touch_queues[self.local_player.id].append((self.tick + 1, turn))
     
   @script
   def loop(self):
@@ -192,50 +307,74 @@ class Game(View):
     self.intro_counter = None
     
     if self.master:
+      # Main loop runs on timed callbacks, see _tick_due and _run_tick
+      first_tick = 0.8*self.tick_interval
+      self.next_tick_at = time.time() + first_tick
+      delay(self._tick_due, first_tick)
+      return
     
-      next_tick_at = time.time() + 0.08
-      # Main loop
-      while len(self.players) > 1 or len(self.derezzes) > 0:       
-        for player in self.players.values():
-          player.get_next_turn(self)
-        delta_to_next_tick = next_tick_at - time.time()
-        yield delta_to_next_tick
-        next_tick_at += 0.1
-        to_be_removed = set()
-        for player in self.players.values():
-          while len(player.track) < len(self.local_player.track):
-            yield 0.01
-          pos = player.track[-1] 
-          #get_next_turn(self)
-          
-          # Collision detection
-          try:
-            collision =  self.grid.matrix[pos[0]][pos[1]] == 1
-          except:
-            print('ex', pos)
-            collision = True
-          if collision:
-            to_be_removed.add((player.id, pos))
-          else:
-            self.grid.matrix[pos[0]][pos[1]] = 1
-        for id, pos in to_be_removed:
-          self.remove_player(id, pos)
-        self.update_display()
-    else:
-      self.receive_loop()
+    self.receive_loop()
+    self.predict_loop()
+    if self.jitter_buffer is not None:
+      self.playback_loop()
     yield 1
     self._callback('winner_exit')
     
+  def _tick_due(self):
+    self.tick += 1
+    self._apply_tempo(self.tick)
+    self.next_tick_at += self.tick_interval
+    self.tick_barrier.wait(self.tick)
+    
+  def schedule_tempo(self, tick, interval):
+    ''' Changes the time between ticks to `interval` seconds from `tick` on, i.e. tick + 1 comes `interval` after tick. '''
+    self.tempo_changes.append((tick, interval))
+    
+  def _apply_tempo(self, tick):
+    while len(self.tempo_changes) > 0 and self.tempo_changes[0][0] <= tick:
+      _, self.tick_interval = self.tempo_changes.popleft()
+    
+  def _run_tick(self, tick):
+    ''' Called by the tick barrier when the inputs for the tick are in. '''
+    for player in self.players.values():
+      player.get_next_turn(self)
+    to_be_removed = set()
+    for player in self.players.values():
+      pos = player.track[-1]
+      
+      # Collision detection
+      try:
+        collision =  self.grid.matrix[pos[0]][pos[1]] == 1
+      except:
+        print('ex', pos)
+        collision = True
+      if collision:
+        to_be_removed.add((player.id, pos))
+      else:
+        self.grid.matrix[pos[0]][pos[1]] = 1
+    for id, pos in to_be_removed:
+      self.remove_player(id, pos)
+    self.update_display()
+    if len(self.players) > 1 or len(self.derezzes) > 0:
+      delay(self._tick_due, max(0, self.next_tick_at - time.time()))
+    else:
+      delay(lambda: self._callback('winner_exit'), 1)
+    
   def update_display(self):
     self.set_needs_display()
     
+  def display_track(self, player):
+    ''' Returns the points to draw for the player. '''
+    return player.track
+    
   def remove_player(self, id, pos):
     self.derezzes.append([0,*pos, self.players[id].color])
     sound.play_effect('arcade:Powerup_1')
-    for (i,j) in self.players[id].track[1:]:
+    for (i,j) in self.players[id].track.positions(1):
       self.grid.matrix[i][j] = 0
     del self.players[id]
     self.player_ids.remove(id)
+    self.tick_barrier.forget(id)
     
   def draw(self):
     sx = self.start_x
@@ -252,13 +391,13 @@ class Game(View):
       p.stroke()
     else:
       for player in self.players.values():
-        track = player.track
+        track = self.display_track(player)
         if len(track) < 2: return
         set_color(player.color)
         p = Path()
         p.line_width = 2
         p.move_to(sx+track[0][0]*3, sy+track[0][1]*3)
-        for point in track[1:-1]:
+        for point in track.positions(1, -1):
           p.line_to(sx+point[0]*3, sy+point[1]*3)
         p.stroke()
         set_color('white')
@@ -291,6 +430,75 @@ class Game(View):
       self.player_found(robot)
       
       
+class JitterBuffer():
+  '''
+  Evens out the arrival of tick frames from the master. Frames are timestamped on arrival, and played back on a steady clock with `pop`, once per tick.
+  
+  Buffer depth (in ticks) follows the measured jitter between `min_depth` and `max_depth`. When the buffer holds more frames than the depth, two frames are released per tick to catch up.
+  '''
+  
+  def __init__(self, interval, min_depth=1, max_depth=5, jitter_factor=2.0):
+    self.interval = interval
+    self.min_depth = min_depth
+    self.max_depth = max_depth
+    self.jitter_factor = jitter_factor
+    self.depth = min_depth
+    self.jitter = 0.0
+    self.frames = deque()
+    self.last_arrival = None
+    self.started = False
+    self.received = 0
+    self.released = 0
+    self.late_frames = 0
+    
+  def push(self, frame):
+    now = time.time()
+    if self.last_arrival is not None:
+      # Smoothed deviation from the tick interval, as in RTP
+      deviation = abs(now - self.last_arrival - self.interval)
+      self.jitter += (deviation - self.jitter)/16
+      depth = math.ceil(self.jitter_factor*self.jitter/self.interval)
+      self.depth = min(self.max_depth, max(self.min_depth, depth))
+    self.last_arrival = now
+    self.frames.append((now, frame))
+    self.received += 1
+    
+  def pop(self):
+    ''' Returns a list of frames due for playback, or None if the next frame is late. '''
+    if not self.started:
+      if len(self.frames) < self.depth:
+        return []
+      self.started = True
+    if len(self.frames) == 0:
+      self.late_frames += 1
+      return None
+    count = 2 if len(self.frames) > self.depth + 1 else 1
+    self.released += count
+    return [self.frames.popleft()[1] for _ in range(count)]
+    
+  def stats(self):
+    return {
+      'depth': self.depth,
+      'buffered': len(self.frames),
+      'jitter': self.jitter,
+      'received': self.received,
+      'released': self.released,
+      'late_frames': self.late_frames
+    }
+
+
+class Commit(multipeer.Message):
+  id: str
+  
+class Sync(multipeer.Message):
+  time: float
+  interval: float
+  
+class Tempo(multipeer.Message):
+  tick: 'I'
+  interval: float
+
+
 class PeerComms(multipeer.MultipeerConnectivity):
   
   def __init__(self, game, player):
@@ -301,7 +509,11 @@ class PeerComms(multipeer.MultipeerConnectivity):
     })
     self.mc_to_game_id = {}
     self.game_to_mc_id = {}
-    super().__init__(display_name='Contender', service_type='lightcycle', initial_data=initial_data, initialize_streams=True)
+    self.partial_turns = {}
+    super().__init__(display_name='Contender', service_type='lightcycle', initial_data=initial_data, initialize_streams=True, heartbeat_interval=0.25, rate_control=True)
+    self.handle(Commit, self.receive_commit)
+    self.handle(Sync, self.receive_sync)
+    self.handle(Tempo, self.receive_tempo)
   
   @on_main_thread
   def peer_added(self, peer_id):
@@ -312,44 +524,64 @@ class PeerComms(multipeer.MultipeerConnectivity):
     self.game.player_found(player)
     
   @on_main_thread
-  def receive(self, msg, from_peer):
-    if msg['action'] == 'commit':
-      self.game.player_committed(msg['id'])
-    elif msg['action'] == 'move':
-      self.game.add_remote_move(msg['id'], msg['pos'])
-    elif msg['action'] == 'sync':
-      self.game.start_game(msg['time'])
-    else:
-      print('Unknown action', msg)
+  def peer_suspected(self, peer_id):
+    # Do not hold every tick for a player that has probably left
+    id = self.mc_to_game_id.get(peer_id.hash())
+    if id is not None:
+      self.game.tick_barrier.forget(id)
+      
+  @on_main_thread
+  def peer_recovered(self, peer_id):
+    id = self.mc_to_game_id.get(peer_id.hash())
+    if id in self.game.remote_player_ids():
+      self.game.tick_barrier.restore(id)
+    
+  @on_main_thread
+  def receive_commit(self, msg, from_peer):
+    self.game.player_committed(msg.id)
+    
+  @on_main_thread
+  def receive_sync(self, msg, from_peer):
+    self.game.start_game(msg.time, msg.interval)
+    
+  @on_main_thread
+  def receive_tempo(self, msg, from_peer):
+    self.game.schedule_tempo(msg.tick, msg.interval)
       
   def stream_receive(self, byte_data, peer_id):
     id = self.mc_to_game_id[peer_id.hash()]
-    while len(byte_data) > 0:
-      if self.game.master:
-        # Getting turns from slaves
-        turn = int(byte_data)
-        self.game.add_remote_turn(id, turn)
-        byte_data = byte_data[2:]
-      else:
-        # From master...
-        self.game.incoming.append(byte_data[0])
-        byte_data = byte_data[1:]
+    if self.game.master:
+      # Getting turns from spokes, 2 bytes of turn + 2 bytes of tick
+      byte_data = self.partial_turns.pop(id, bytearray()) + byte_data
+      while len(byte_data) >= 4:
+        turn = int(byte_data[:2])
+        tick = int.from_bytes(byte_data[2:4], 'big')
+        self.game.add_remote_turn(id, turn, tick)
+        byte_data = byte_data[4:]
+      if len(byte_data) > 0:
+        self.partial_turns[id] = byte_data
+    else:
+      # From master...
+      self.game.incoming.extend(byte_data)
       
   def send_commit(self, id):
-    self.send({
-      'action': 'commit',
-      'id': id
-    })
+    self.send_message(Commit(id))
     
-  def send_sync(self, start_time):
-    self.send({
-      'action': 'sync',
-      'time': start_time
-    })
+  def send_sync(self, start_time, interval):
+    self.send_message(Sync(start_time, interval))
+    
+  def send_tempo(self, tick, interval):
+    self.send_message(Tempo(tick, interval))
     
-  def send_turn(self, master_id, turn):
+  def round_trip_time(self, id):
+    ''' Smoothed round-trip time to the player in seconds, or None if not measured yet. '''
+    peer_id = self.game_to_mc_id.get(id)
+    budget = peer_id and self.get_send_budget(peer_id)
+    return budget and budget['rtt']
+    
+  def send_turn(self, master_id, turn, tick):
     peer_id = self.game_to_mc_id[master_id]
-    packet = ('+' + str(turn))[-2:].encode()
+    packet = ('+' + str(turn))[-2:].encode() + (tick % 65536).to_bytes(2, 'big')
     self.stream(packet, peer_id)
     
   def send_removal(self, id, pos):
@@ -367,15 +599,56 @@ class PeerComms(multipeer.MultipeerConnectivity):
 
       
 class PeerGame(Game):
-  def __init__(self, **kwargs):
+  '''
+  Game against other devices. The first player in id order acts as the master that runs the game and sends positions to the others, spokes.
+  
+  Spokes predict the movement of their own bike so that turns show up without waiting for the master. `input_delay` (in ticks) postpones local turns to give them time to reach the master before they are due, and `mispredictions` counts the ticks where the prediction had to be corrected.
+  
+  Spokes play positions from the master back through a `JitterBuffer`. Pass `jitter_buffer=False` to apply them as soon as they arrive, or a `JitterBuffer` instance to configure it.
+  
+  With `adaptive_tempo`, the master picks the time between ticks from the measured round-trip times to the spokes, `rtt_factor` times the slowest, within `min_tick_interval` and `max_tick_interval`, and announces it with the start time. Every `tempo_window` ticks it slows down if more than `late_tolerance` of the ticks had to wait out the input deadline, and otherwise moves back towards the rate the round-trip times allow. Changes are announced for a tick far enough ahead to reach every spoke first, so all devices switch on the same tick.
+  '''
+  
+  def __init__(self, input_delay=0, prediction_history=64, jitter_buffer=True, adaptive_tempo=True, min_tick_interval=0.05, max_tick_interval=0.2, rtt_factor=1.5, tempo_window=50, late_tolerance=0.1, **kwargs):
     super().__init__(**kwargs)
+    self.adaptive_tempo = adaptive_tempo
+    self.min_tick_interval = min_tick_interval
+    self.max_tick_interval = max_tick_interval
+    self.rtt_factor = rtt_factor
+    self.tempo_window = tempo_window
+    self.late_tolerance = late_tolerance
+    self.tempo_floor = min_tick_interval
+    self.window_missed = 0
+    if jitter_buffer is True:
+      jitter_buffer = JitterBuffer(self.tick_interval)
+    self.jitter_buffer = jitter_buffer or None
+    self.late = False
     self.mc = PeerComms(self, self.local_player)
     self.mc.start_looking_for_peers()
     self.incoming = deque()
+    self.input_delay = input_delay
+    self.pending_inputs = deque()
+    self.predicted = deque(maxlen=prediction_history)
+    self.last_input_tick = 0
+    self.predicted_ticks = 0
+    self.mispredictions = 0
+    self.ended = False
+    
+  @property
+  def predicted_tick(self):
+    return self.predicted[-1][0] if len(self.predicted) > 0 else 0
+    
+  @property
+  def misprediction_rate(self):
+    if self.predicted_ticks == 0: return 0.0
+    return self.mispredictions/self.predicted_ticks
     
   @script
   def receive_loop(self):
     self.buffer = bytearray()
+    # Removals are delivered together with the positions of the same tick
+    removals = []
+    player_count = len(self.players)
     while len(self.players) > 1 or len(self.derezzes) > 0:
       self._read_n()
       yield
@@ -384,16 +657,40 @@ class PeerGame(Game):
         yield
         id = self.buffer[:36].decode()
         pos = (self.buffer[36], self.buffer[37])
-        self.remote_remove_player(id, pos)
+        removals.append((id, pos))
+        player_count -= 1
       else: # ... Positions
         poss = []
-        for _ in range(len(self.players)):
+        for _ in range(player_count):
           self._read_n(2)
           yield
           poss.append((self.buffer[0], self.buffer[1]))
-        self.add_remote_poss(poss)
+        if self.jitter_buffer is None:
+          self._apply_frame(removals, poss)
+        else:
+          self.jitter_buffer.push((removals, poss))
+        removals = []
     yield 1
     self._callback('winner_exit')
+    
+  @script
+  def playback_loop(self):
+    next_tick_at = time.time() + self.tick_interval
+    while len(self.players) > 1 or len(self.derezzes) > 0:
+      yield next_tick_at - time.time()
+      next_tick_at += self.tick_interval
+      frames = self.jitter_buffer.pop()
+      self.late = frames is None
+      if self.late:
+        super().update_display()
+        continue
+      for removals, poss in frames:
+        self._apply_frame(removals, poss)
+        
+  def _apply_frame(self, removals, poss):
+    for id, pos in removals:
+      self.remote_remove_player(id, pos)
+    self.add_remote_poss(poss)
   
   @script
   def _read_n(self, n=1):
@@ -402,6 +699,115 @@ class PeerGame(Game):
       while len(self.incoming) == 0:
         yield
       self.buffer.append(self.incoming.popleft())
+      
+  @script
+  def predict_loop(self):
+    player = self.local_player
+    self.predicted.append((0, player.track[0], player.direction))
+    next_tick_at = time.time() + 0.8*self.tick_interval
+    while player.id in self.players and len(self.players) > 1:
+      yield next_tick_at - time.time()
+      if self.ended or player.id not in self.players or len(self.players) < 2:
+        break
+      tick, pos, direction = self.predicted[-1]
+      self._apply_tempo(tick + 1)
+      next_tick_at += self.tick_interval
+      self.predicted.append(self._predict_step(tick + 1, pos, direction))
+      self.predicted_ticks += 1
+      super().update_display()
+      # Let the master know there are no more turns coming for the tick
+      tick = self.predicted_tick + self.input_delay
+      if tick > self.last_input_tick:
+        self.last_input_tick = tick
+        self.mc.send_turn(self.master_id, 0, tick)
+    # Game over, show only the authoritative positions from here on
+    self.predicted.clear()
+    super().update_display()
+      
+  def _predict_step(self, tick, pos, direction):
+    for input_tick, turn in self.pending_inputs:
+      if input_tick == tick:
+        direction = (direction + turn) % 4
+    delta = Player.directions[direction]
+    return (tick, (pos[0] + delta[0], pos[1] + delta[1]), direction)
+    
+  def _reconcile(self):
+    ''' Compares the authoritative position of the local player with the prediction for the same tick, and on a mismatch rewinds to the authoritative state and replays the pending inputs. '''
+    track = self.local_player.track
+    tick = len(track) - 1
+    while len(self.pending_inputs) > 0 and self.pending_inputs[0][0] <= tick:
+      self.pending_inputs.popleft()
+    if len(self.predicted) == 0: return
+    index = tick - self.predicted[0][0]
+    if 0 <= index < len(self.predicted):
+      if self.predicted[index][1] == track[-1]:
+        return
+      self.mispredictions += 1
+    last_tick = max(self.predicted_tick, tick)
+    delta = (track[-1][0] - track[-2][0], track[-1][1] - track[-2][1])
+    state = (tick, track[-1], Player.directions.index(delta))
+    self.predicted.clear()
+    self.predicted.append(state)
+    while state[0] < last_tick:
+      state = self._predict_step(state[0] + 1, *state[1:])
+      self.predicted.append(state)
+      
+  def display_track(self, player):
+    track = player.track
+    if self.master or len(track) < 2:
+      return track
+    if player is self.local_player:
+      tick = len(track) - 1
+      return track + [pos for t, pos, _ in self.predicted if t > tick]
+    if self.late:
+      # Next tick has not arrived yet, continue along the last move
+      (x0, y0), (x1, y1) = track[-2:]
+      return track + [(2*x1 - x0, 2*y1 - y0)]
+    return track
+    
+  def _apply_tempo(self, tick):
+    super()._apply_tempo(tick)
+    if self.jitter_buffer is not None:
+      self.jitter_buffer.interval = self.tick_interval
+      
+  def _round_trip_times(self):
+    rtts = [self.mc.round_trip_time(id) for id in self.remote_player_ids()]
+    return [rtt for rtt in rtts if rtt is not None]
+    
+  def _rtt_interval(self):
+    ''' Tick interval the measured round-trip times allow. '''
+    rtts = self._round_trip_times()
+    if len(rtts) == 0:
+      return self.tick_interval
+    interval = self.rtt_factor*max(rtts)
+    return min(self.max_tick_interval, max(self.min_tick_interval, interval))
+    
+  # Master
+  def _tick_due(self):
+    super()._tick_due()
+    if self.adaptive_tempo and self.tick % self.tempo_window == 0:
+      self._adapt_tempo()
+      
+  def _adapt_tempo(self):
+    missed = self.tick_barrier.missed - self.window_missed
+    self.window_missed = self.tick_barrier.missed
+    if len(self.tempo_changes) > 0:
+      return
+    if missed > self.late_tolerance*self.tempo_window:
+      interval = min(self.max_tick_interval, 1.25*self.tick_interval)
+      # Do not speed up past a rate that was already too fast
+      self.tempo_floor = max(self.tempo_floor, interval)
+    elif missed == 0:
+      interval = max(self._rtt_interval(), 0.9*self.tick_interval, self.tempo_floor)
+    else:
+      return
+    if abs(interval - self.tick_interval) < 0.005:
+      return
+    # Far enough ahead for the announcement to reach the spokes
+    slowest = max(self._round_trip_times() + [self.tick_interval])
+    tick = self.tick + math.ceil(slowest/self.tick_interval) + 2
+    self.schedule_tempo(tick, interval)
+    self.mc.send_tempo(tick, interval)
     
   def player_committed(self, id):
     if id == self.local_player.id:
@@ -411,31 +817,50 @@ class PeerGame(Game):
   def all_players_committed(self):
     self.mc.stop_looking_for_peers()
     self.finalize_players()
-    self.master = self.player_ids[0] == self.local_player.id
+    self.master_id = self.player_ids[0]
+    self.master = self.master_id == self.local_player.id
     if self.master:
+      if self.adaptive_tempo:
+        self.schedule_tempo(0, self._rtt_interval())
+        self._apply_tempo(0)
       self.start_time = time.time() + 2.0
-      self.mc.send_sync(self.start_time)
+      self.mc.send_sync(self.start_time, self.tick_interval)
       self._callback('all_players_committed')
 
-  def start_game(self, timestamp):
-    ''' Master is telling us when the game starts '''
+  def start_game(self, timestamp, interval=None):
+    ''' Master is telling us when the game starts and how fast it runs '''
     self.start_time = timestamp
+    if interval is not None:
+      self.schedule_tempo(0, interval)
+      self._apply_tempo(0)
     self._callback('all_players_committed')
     
   def add_turn(self, turn):
     if self.master:
       super().add_turn(turn)
     else:
-      self.mc.send_turn(self.player_ids[0], turn)
+      tick = max(self.predicted_tick + 1 + self.input_delay, self.last_input_tick + 1)
+      self.last_input_tick = tick
+      self.pending_inputs.append((tick, turn))
+      self.mc.send_turn(self.master_id, turn, tick)
+      
+  def remote_player_ids(self):
+    return [id for id in self.player_ids if id in self.mc.game_to_mc_id]
       
   # Master
-  def add_remote_turn(self, id, turn):
-    self.touch_queues.setdefault(id, deque()).append(turn)
+  def add_remote_turn(self, id, turn, tick):
+    # Sent modulo 65536, unwrapped to the nearest tick
+    tick = self.tick + (tick - self.tick + 32768) % 65536 - 32768
+    if turn != 0:
+      self.touch_queues[id].append((tick, turn))
+    self.tick_barrier.arrive(id, tick)
     
   # Spoke
   def add_remote_poss(self, poss):
     for i, id in enumerate(self.player_ids):
       self.players[id].track.append(poss[i])
+    if self.local_player.id in self.players:
+      self._reconcile()
     super().update_display()
     
   # Master
@@ -454,6 +879,7 @@ class PeerGame(Game):
     super().remove_player(id, pos)
     
   def end_game(self):
+    self.ended = True
     self.mc.end_all()
       
 class MenuBike(View):
@@ -588,8 +1014,36 @@ class StartMenu(View):
     if hasattr(self, 'game'):
       self.game.end_game()
 
+def benchmark_tracks(robots=8, ticks=5000, draw_every=10):
+  ''' Compares memory use and time of a game's worth of tracks stored as lists of tuples and as `Track` arrays. Every `draw_every` ticks all tracks are walked once, as `Game.draw` does. Returns a dict with the figures and prints them. '''
+  import tracemalloc
+  results = {}
+  for name, factory in (('list', list), ('track', Track)):
+    tracemalloc.start()
+    started = time.perf_counter()
+    tracks = [factory() for _ in range(robots)]
+    for tick in range(ticks):
+      for i, track in enumerate(tracks):
+        track.append((tick % 100, (tick // 100 + i) % 100))
+      if tick % draw_every == 0:
+        for track in tracks:
+          for x, y in track:
+            pass
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    results[name] = {'seconds': elapsed, 'bytes': size}
+    print('%-5s  %8.3f s  %10d bytes' % (name, elapsed, size))
+    del tracks
+  return results
+  
+
 if __name__ == '__main__':
   
+  if 'benchmark' in sys.argv[1:]:
+    benchmark_tracks()
+    sys.exit()
+  
   game_type = PeerGame
   #game_type = Game
   no_of_robots = 0
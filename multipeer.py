@@ -77,6 +77,36 @@ JSON-serializes the message you give to the `send` method (probably a str or
 a dict), then encodes it in bytes. Receiving peers reconstitute the message
 and pass it to the `receive` callback.
 
+For numeric data like sensor frames or NumPy arrays, `send_buffer` sends
+the memory of any object that supports the buffer protocol as is, with a
+small header giving the format and shape. This is much faster and more
+compact than converting the numbers to JSON. Receiving peers get a NumPy
+array, or a memoryview if NumPy is not available, that views the received
+bytes, with the `buffer_receive` callback. Run `multipeer.py` with the
+`buffers` argument to compare the two for different sizes.
+
+## Typed messages
+
+Apps that send many small messages of a few known kinds can declare them
+as subclasses of `Message`, with the fields and their types as annotations,
+and send them with `send_message`. Each class gets generated `struct` code
+that encodes the fields as compact binary, and a type ID derived from the
+class name and fields. Receiving peers decode the message with the code of
+its type and call the handler set for the type with `handle`, found with a
+single dict lookup, instead of parsing JSON and checking a field to decide
+what to do with it:
+
+    class Turn(multipeer.Message):
+        tick: 'I'
+        turn: 'b'
+
+    mc.handle(Turn, lambda msg, peer_id: print(msg.tick, msg.turn))
+    mc.send_message(Turn(tick=12, turn=-1))
+
+Peers compare the type IDs of their message classes when they connect, and
+`schema_mismatch` is called if a peer declares a class with the same name
+but different fields, typically because it runs another version of the app.
+
 ## Streaming
 
 There are methods to use streaming instead of simple messages. Streamed data
@@ -84,6 +114,17 @@ is received in 1024 byte chunks. There is a constructor option
 `initialize_streams` that can be used to set up a stream with each connected
 peer; otherwise, the streams are initialized when needed.
 
+Giving a `channel` name to the `stream` method opens a separate stream per
+channel and peer. Data on named channels is received with the
+`channel_receive` callback. Each stream buffers the data that the network
+can not take yet, so a busy bulk channel does not hold back e.g. a telemetry
+channel. See `set_channel_limit` for limiting the buffering.
+
+For large payloads, `send_bulk` splits the data over several parallel
+streams to the peer and the receiver reassembles it in order before passing
+it to the `bulk_receive` callback. The number of streams is adjusted based on
+the throughput measured by the receiver.
+
 ## Performance
 
 Pythonista forum user `mithrendal` ran some ping tests with very small data
@@ -100,6 +141,89 @@ performance concern.
 * Streaming may be significantly better if
 communications delay is an issue.
 
+## Rate control
+
+Nothing stops an app from sending faster than the link can carry, which
+fills the framework buffers and makes the latency of everything grow. With
+the `rate_control` constructor argument, the data sent to each peer is
+paced to a rate that is adjusted continuously: it grows slowly while the
+measured round-trip time stays low, and drops quickly when the round-trip
+time grows, or when writes to a stream come up short. Data over the rate is
+queued and sent as the budget allows. Apps can follow the current rate with
+`get_send_budget` and the `rate_changed` callback, and lower their update
+rate instead of building up queues.
+
+To catch performance regressions in this module before trying it on
+devices, `multipeer_loadgen.py` runs scripted chat, game tick, bulk and
+churn traffic between peers in one process, and prints the throughput,
+latency percentiles and memory use.
+
+## Publish and subscribe
+
+Instead of sending to everyone and filtering on the receiving side, peers
+can `subscribe` to topics like `'sensors/temperature'` and others can
+`publish` messages to a topic. Peers share their subscriptions, so
+messages are only sent to peers subscribed to the topic, and received
+with the `topic_receive` callback. Subscriptions can use wildcards: `+`
+matches one level of the topic and `#` at the end matches any number of
+levels, e.g. `'sensors/+'` or `'sensors/#'`.
+
+## Remote calls
+
+For request-response exchanges, a peer can `register` handler functions by
+name, and other peers can `call` them. `call` returns immediately with a
+`concurrent.futures.Future` for the result, so several calls can be in
+flight to the same peer at once instead of waiting for each reply before
+sending the next request. Calls can time out and be cancelled.
+
+## Failure detection
+
+The framework can take many seconds to report that a peer has walked out of
+range. With the `heartbeat_interval` constructor argument, peers send each
+other small unreliable heartbeat messages, and a phi accrual failure
+detector estimates from their timing how likely it is that a peer has
+failed. `peer_suspected` is called when the estimate crosses
+`phi_threshold`, usually well before `peer_removed`, and `peer_recovered`
+if heartbeats start arriving again. Lower thresholds detect failures faster
+but cause more false alarms.
+
+## Resuming sessions
+
+Normally a peer that drops and comes back is treated as a new peer. With
+the `resume_timeout` constructor argument, each peer gets a stable key that
+is carried with the invitations, and a peer that drops is kept for that
+many seconds while the peers try to reconnect, inviting again with
+increasing delays. If the peer comes back in time, its streams are opened
+again with the data that was still waiting to be written, the reliable
+messages it did not yet acknowledge are sent again, and `peer_resumed` is
+called instead of `peer_removed` and `peer_added`. Messages sent to all
+peers during the drop are delivered after the reconnection. Data already
+written to the old streams is not sent again.
+
+## Recording and replay
+
+To analyze performance problems after the fact, call `start_recording` with
+a file name. All sent and received messages, streamed data and added and
+removed peers are then written to a compact binary log with monotonic
+timestamps.
+
+The `replay` function feeds the log back to an instance of your subclass with
+the original timing or faster, so that your handlers can be profiled and
+timing problems reproduced without the devices. Use `read_log` to inspect
+the records directly.
+
+## Tracing
+
+To see where the time goes between calling `send` on one device and the
+`receive` callback running on another, call `start_tracing` on every peer.
+Each sent message then gets an ID, and both ends keep timed spans of it,
+e.g. encoding, waiting in the send queue, the framework call, decoding
+and the handler, in a bounded in-memory ring. `export_trace` returns the
+spans in the Chrome Trace Event format, and `merge_traces` combines the
+exports of all peers into one timeline, with the clocks of the devices
+aligned and arrows from each send to its receipt. Open the result in
+`chrome://tracing` or the Perfetto UI.
+
 ## What is a peer ID?
 
 Peer IDs passed around by the wrapper have a `display_name` member that
@@ -121,6 +245,7 @@ methods; see the API for the method signatures:
 * `peer_removed`
 * `receive`
 * `stream_receive`
+* `channel_receive`
 
 The versions of these methods in the `MultipeerConnectivity` class just
 print out the information received.
@@ -130,17 +255,27 @@ Note that if these method update the UI, you should decorate them with
 
 ## Additional details
 
-* This implementation uses automatic invite of all peer◊s (until you call
-`stop_looking_for_peers`). Future version may include a callback for making
-decisions on which peers to accept.
-* Related to the previous point, including discovery info while browsing for
-peers is not currently supported.
+* This implementation invites all peers found (until you call
+`stop_looking_for_peers`), unless you override `admit_peer` or
+`accept_peer` to decide which peers to invite and accept. Peers can publish
+information for this decision with the `discovery_info` constructor
+argument.
 * Also, there is no way to explicitly kick a specific peer out of a session.
 This seems to be a limitation of the Apple framework.
-* Following defaults are used and are not currently configurable without
-resorting to ObjC:
-* Secure - Encryption is required on all connections.
-* Not secure - A specific security identity cannot be set.
+* By default, encryption is required on all connections. For trusted local
+setups, the `encryption` constructor argument can be set to `'optional'` or
+`'none'` to save latency and CPU. Run `multipeer.py` with the `probe`
+argument on two devices, or call `probe_latency`, to measure the difference.
+* A specific security identity can be set with the `security_identity`
+constructor argument.
+* Sending methods can be called from any thread, e.g. UI actions, `@script`
+functions and the callbacks. Data from all threads goes through a queue and
+is handed to the session and the streams by one thread at a time, in the
+order it was sent. The thread that finds no other thread sending does it,
+so there is no extra thread switch when only one thread sends. A sending
+method returns once its data has been handed over, and raises any error
+that came up doing it. The `threads` mix of `multipeer_loadgen.py` checks
+this under load.
 
 ## Version history
 
@@ -151,7 +286,10 @@ resorting to ObjC:
 __version__ = '1.0.1'
 
 from objc_util import *
-import ctypes, re, json, heapq
+import ctypes, re, json, heapq, itertools, math, struct, time, threading
+import traceback, uuid, zlib
+import concurrent.futures
+from collections import deque
 
 # MC framework classes
 NSBundle.bundle(Path="/System/Library/Frameworks/MultipeerConnectivity"
@@ -161,44 +299,155 @@ MCSession = ObjCClass('MCSession')
 MCNearbyServiceAdvertiser = ObjCClass('MCNearbyServiceAdvertiser')
 MCNearbyServiceBrowser = ObjCClass('MCNearbyServiceBrowser')
 NSRunLoop = ObjCClass('NSRunLoop')
+NSMutableData = ObjCClass('NSMutableData')
 NSDefaultRunLoopMode = ObjCInstance(c_void_p.in_dll(c, "NSDefaultRunLoopMode"))
 
-# Global variable and a helper function for accessing Python manager object
-# from ObjC functions. Dictionary is used to support running more than one
-# MC object simultaneously.
+# Global variables and a helper function for accessing Python manager object
+# from ObjC functions. Dictionaries are used to support running more than one
+# MC object simultaneously, and are keyed by the raw pointers that the
+# delegate functions receive, so that finding the manager takes no ObjC calls.
 
+# Session, browser and advertiser pointer -> manager
 mc_managers = {}
+# Input stream pointer -> (manager, peer ID, channel, stream)
 mc_inputstream_managers = {}
+# Output stream pointer -> (manager, (peer hash, channel))
+mc_outputstream_managers = {}
+# Delegate functions look the registries up without locking, but changes to
+# them, and to the stream and peer ID dicts, peer states and invitations of
+# the managers, are made under this lock, so that peers can come and go on
+# any thread
+_registry_lock = threading.RLock()
+
+# Name of the stream used when no channel is given
+DEFAULT_STREAM = 'stream'
+
+# Prefix of the channels used by send_bulk, and the range and segment size
+_STRIPE_CHANNEL = '_stripe'
+MAX_STRIPES = 4
+_STRIPE_SEGMENT_SIZE = 16384
+# Transfer ID, segment sequence number, segment count, segment length
+_stripe_header = struct.Struct('>IIII')
+
+# MCEncryptionPreference values
+ENCRYPTION_PREFERENCES = {
+    'optional': 0,
+    'required': 1,
+    'none': 2,
+}
+
+# Internal messages start with this byte, which never starts a JSON text
+_CONTROL_PREFIX = b'\x01'
+
+# Messages sent while tracing start with this byte and the message ID
+_TRACED_PREFIX = b'\x05'
+_trace_header = struct.Struct('>Q')
+_TRACED_SIZE = 1 + _trace_header.size
+
+# Messages sent with send_buffer start with this byte
+_BUFFER_PREFIX = b'\x03'
+
+# Reliable data of resumable sessions starts with this byte and a sequence
+# number
+_SEQUENCED_PREFIX = b'\x02'
+_sequence_header = struct.Struct('>Q')
+
+# Received sequenced messages between acknowledgements
+_ACK_INTERVAL = 16
+
+# First and maximum delay in seconds between invitations to a dropped peer
+_REINVITE_DELAY = 0.5
+_MAX_REINVITE_DELAY = 8.0
+
+# Invitation timeout of the framework, used when invite_timeout is 0
+_DEFAULT_INVITE_TIMEOUT = 30.0
+
+# Rate control: rates in bytes per second, the burst that can be sent at
+# once in seconds at the current rate, and the queueing delay that counts as
+# congestion, relative to the lowest round-trip time seen
+_INITIAL_RATE = 64*1024
+_MIN_RATE = 4*1024
+_MAX_RATE = 8*1024*1024
+_RATE_INCREASE = 16*1024
+_RATE_DECREASE = 0.7
+_PACING_BURST = 0.05
+_PACING_INTERVAL = 0.005
+_RATE_PROBE_INTERVAL = 0.25
+_QUEUE_RTT_FACTOR = 1.5
+_QUEUE_RTT_MARGIN = 0.005
+_MIN_RTT_WINDOW = 10.0
+
+# Discovery info key for the random token used to decide which peer invites
+_TOKEN_KEY = '_mc_token'
+
+# Discovery info and invitation context key for the stable key of a peer
+_PEER_KEY = '_mc_key'
+
+# Connection states of peers, see get_peer_state
+PEER_INVITED = 'invited'
+PEER_CONNECTED = 'connected'
+PEER_ADDED = 'added'
+PEER_DROPPED = 'dropped'
+
+def _pointer(objc_object):
+    """ Returns the address of an ObjCInstance or a raw pointer as an int. """
+    ptr = getattr(objc_object, 'ptr', objc_object)
+    return getattr(ptr, 'value', ptr)
+
 
 def get_self(manager_object):
     """ Expects a 'manager object', i.e. one of session, advertiser or
-    browser, and uses the contained peer ID to locate the right Python manager
-    object. """
-    global mc_managers
-    return mc_managers.get(
-        ObjCInstance(manager_object).myPeerID().hash(),
-        None)
+    browser, and returns the Python manager object that created it. """
+    return mc_managers.get(_pointer(manager_object), None)
 
 # MC Framework delegate definitions
 
 def session_peer_didChangeState_(_self,_cmd,_session,_peerID,_state):
     self = get_self(_session)
     if self is None: return
-    peerID = ObjCInstance(_peerID)
-    peerID.display_name = str(peerID.displayName())
+    peerID = self._get_peer(_peerID)
     if _state == 2:
-        self._peer_collector(peerID)
+        self._peer_connected(peerID)
+        self._invite_finished(peerID, True)
     if (_state is None or _state == 0):
-        self.peer_removed(peerID)
+        self._invite_finished(peerID, False)
+        self._peer_disconnected(peerID)
 
 
 def session_didReceiveData_fromPeer_(_self, _cmd, _session, _data, _peerID):
+    started = time.time()
     self = get_self(_session)
     if self is None: return
-    peer_id = ObjCInstance(_peerID)
-    peer_id.display_name = str(peer_id.displayName())
-    decoded_data = nsdata_to_bytes(ObjCInstance(_data)).decode()
-    message = json.loads(decoded_data)
+    peer_id = self._get_peer(_peerID)
+    data = nsdata_to_bytes(ObjCInstance(_data))
+    if data[:1] == _SEQUENCED_PREFIX:
+        data = self._receive_sequenced(data, peer_id)
+        if data is None:
+            return
+    if data[:1] == _TRACED_PREFIX:
+        msg_id, = _trace_header.unpack_from(data, 1)
+        data = data[_TRACED_SIZE:]
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.span('receive', started, msg_id)
+            self._receive_traced(data, peer_id, msg_id)
+            return
+    if data[:1] == _BUFFER_PREFIX:
+        if self.recorder is not None:
+            self.recorder.write(RECORD_BUFFER_RECEIVE, peer_id, data)
+        self.buffer_receive(_decode_buffer(data), peer_id)
+        return
+    if data[:1] == _MESSAGE_PREFIX:
+        if self.recorder is not None:
+            self.recorder.write(RECORD_MESSAGE_RECEIVE, peer_id, data)
+        self._dispatch_message(data, peer_id)
+        return
+    if data[:1] == _CONTROL_PREFIX:
+        self._receive_control(json.loads(data[1:].decode()), peer_id)
+        return
+    if self.recorder is not None:
+        self.recorder.write(RECORD_RECEIVE, peer_id, data)
+    message = json.loads(data.decode())
     self.receive(message, peer_id)
 
 
@@ -207,10 +456,13 @@ def session_didReceiveStream_withName_fromPeer_(_self, _cmd, _session, _stream,
     self = get_self(_session)
     if self is None: return
     stream = ObjCInstance(_stream)
-    peer_id = ObjCInstance(_peerID)
+    peer_id = self._get_peer(_peerID)
+    channel = str(ObjCInstance(_streamName))
     stream.setDelegate_(ObjCInstance(_self))
-    mc_inputstream_managers[stream] = self
-    self.peer_per_inputstream[stream] = peer_id
+    with _registry_lock:
+        mc_inputstream_managers[_pointer(_stream)] = (self, peer_id, channel,
+            stream)
+        self.inputstreams[_pointer(_stream)] = stream
     stream.scheduleInRunLoop_forMode_(NSRunLoop.mainRunLoop(),
         NSDefaultRunLoopMode)
     stream.open()
@@ -218,14 +470,52 @@ def session_didReceiveStream_withName_fromPeer_(_self, _cmd, _session, _stream,
 
 def stream_handleEvent_(_self, _cmd, _stream, _event):
     if _event == 2:  # hasBytesAvailable
+        started = time.time()
+        self, peer_id, channel, stream = mc_inputstream_managers.get(_stream,
+            (None, None, None, None))
+        if self is None: return
         buffer = ctypes.create_string_buffer(1024)
-        stream = ObjCInstance(_stream)
         read_len = stream.read_maxLength_(buffer, 1024)
         if read_len > 0:
             content = bytearray(buffer[:read_len])
-            self = mc_inputstream_managers[stream]
-            peer_id = self.peer_per_inputstream[stream]
-            self.stream_receive(content, peer_id)
+            tracer = self.tracer
+            if tracer is not None:
+                tracer.span('stream read', started, channel=channel,
+                    bytes=read_len)
+                started = time.time()
+            if channel == DEFAULT_STREAM:
+                if self.recorder is not None:
+                    self.recorder.write(RECORD_STREAM_RECEIVE, peer_id,
+                        content)
+                self.stream_receive(content, peer_id)
+            elif channel.startswith(_STRIPE_CHANNEL):
+                self._receive_stripe(channel, content, peer_id)
+            else:
+                if self.recorder is not None:
+                    self.recorder.write(RECORD_CHANNEL_RECEIVE, peer_id,
+                        _channel_payload(channel, content))
+                self.channel_receive(channel, content, peer_id)
+            if tracer is not None:
+                tracer.span('stream handler', started, channel=channel)
+    elif _event == 4:  # hasSpaceAvailable
+        self, key = mc_outputstream_managers.get(_stream, (None, None))
+        if self is not None:
+            # Not waited for, as the run loop must not block on a writer
+            # that may be waiting for the main thread
+            self._outbox.append((self._flush_stream, (key,), None))
+            self._drain_outbox()
+    elif _event in (8, 16):  # errorOccurred, endEncountered
+        self, _, _, _ = mc_inputstream_managers.get(_stream,
+            (None, None, None, None))
+        if self is not None:
+            self._forget_inputstream(_stream)
+
+
+def _close_stream(stream):
+    stream.setDelegate_(None)
+    stream.removeFromRunLoop_forMode_(NSRunLoop.mainRunLoop(),
+        NSDefaultRunLoopMode)
+    stream.close()
 
 
 SessionDelegate = create_objc_class('SessionDelegate',
@@ -244,17 +534,38 @@ def browser_foundPeer_withDiscoveryInfo_(_self, _cmd, _browser, _peerID,
     self = get_self(_browser)
     if self is None: return
 
-    peerID = ObjCInstance(_peerID)
-    browser = ObjCInstance(_browser)
-    context = json.dumps(
-        self.initial_data).encode() if self.initial_data is not None else None
-    browser.invitePeer_toSession_withContext_timeout_(peerID, self.session,
-        context, 0)
+    # Not cached, as most peers found may never connect
+    peerID = self._get_peer(_peerID, cache=False)
+    discovery_info = None
+    peer_key = None
+    if _info is not None:
+        info = ObjCInstance(_info)
+        discovery_info = { str(key): str(info.objectForKey_(key))
+            for key in info.allKeys() }
+        token = discovery_info.pop(_TOKEN_KEY, None)
+        if (self.invite_mode == 'single' and token is not None and
+                token < self.peer_token):
+            # Peer with the lower token invites
+            return
+        peer_key = discovery_info.pop(_PEER_KEY, None)
+    if self.admit_peer(peerID, discovery_info):
+        if peer_key is not None:
+            # Becomes the key of the peer when the invitation is sent
+            self._discovered_keys[peerID.hash()] = peer_key
+        self._invite(peerID)
 
 
 def browser_lostPeer_(_self, _cmd, browser, peer):
-    # print ('lost peer')
-    pass
+    self = get_self(browser)
+    if self is None: return
+    lost_peer = ObjCInstance(peer)
+    peer_hash = lost_peer.hash()
+    with _registry_lock:
+        self.invite_queue = deque(peer_id for peer_id in self.invite_queue
+            if peer_id.hash() != peer_hash)
+        self._discovered_keys.pop(peer_hash, None)
+    # The session may never report on an invitation to a peer that is gone
+    self._invite_finished(lost_peer, False)
 
 
 BrowserDelegate = create_objc_class('BrowserDelegate',
@@ -283,17 +594,26 @@ def advertiser_didReceiveInvitationFromPeer_withContext_invitationHandler_(
         _self, _cmd, _advertiser, _peerID, _context, _invitationHandler):
     self = get_self(_advertiser)
     if self is None: return
-    peer_id = ObjCInstance(_peerID)
+    peer_id = self._get_peer(_peerID)
+    initial_data = None
+    peer_key = None
     if _context is not None:
         decoded_data = nsdata_to_bytes(ObjCInstance(_context)).decode()
         initial_data = json.loads(decoded_data)
-        self.initial_peer_data[peer_id.hash()] = initial_data
-    peer_id.display_name = str(peer_id.displayName())
-    self._peer_collector(peer_id)
+        if type(initial_data) == dict and _PEER_KEY in initial_data:
+            peer_key = initial_data[_PEER_KEY]
+            initial_data = initial_data['initial_data']
+    accept = self.accept_peer(peer_id, initial_data)
+    if accept:
+        if peer_key is not None:
+            self._peer_keys[peer_id.hash()] = peer_key
+        if _context is not None:
+            self.initial_peer_data[peer_id.hash()] = initial_data
+        self._handshake_complete(peer_id)
+    # Handler is called before returning, so it does not need to be retained
     invitation_handler = ObjCInstance(_invitationHandler)
-    retain_global(invitation_handler)
     blk = _block_literal.from_address(_invitationHandler)
-    blk.invoke(invitation_handler, True, self.session)
+    blk.invoke(invitation_handler, accept, self.session)
 
 
 f = advertiser_didReceiveInvitationFromPeer_withContext_invitationHandler_
@@ -304,6 +624,740 @@ AdvertiserDelegate = create_objc_class('AdvertiserDelegate', methods=[
     advertiser_didReceiveInvitationFromPeer_withContext_invitationHandler_])
 ADelegate = AdvertiserDelegate.alloc().init()
 
+
+class RPCError(Exception):
+    """ Raised by the futures returned by `MultipeerConnectivity.call` when
+    the remote handler failed, or did not exist. """
+
+
+# Topic matching for publish and subscribe
+
+def _is_pattern(topic):
+    return '+' in topic or '#' in topic
+
+
+def _topic_matches(pattern, topic):
+    """ Checks a topic against a subscription with `+` (one level) and
+    `#` (rest of the levels) wildcards. """
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class _TopicIndex():
+    """ Subscriptions of the peers by topic and by wildcard pattern,
+    with the subscribers of recently published topics cached until the
+    subscriptions change. Changed on the delegate thread and read on the
+    publishing threads, so all access is under `lock`. """
+
+    def __init__(self, cache_size=256):
+        self.lock = threading.Lock()
+        self.peer_ids = {}
+        self.topics_per_peer = {}
+        self.peers_per_topic = {}
+        self.peers_per_pattern = {}
+        # Topic -> subscriber peer IDs, only for topics with subscribers
+        self.targets = {}
+        self.cache_size = cache_size
+
+    def replace(self, peer_id, topics):
+        """ Sets the subscriptions of the peer. """
+        peer_hash = peer_id.hash()
+        with self.lock:
+            self._remove(peer_hash)
+            if len(topics) == 0:
+                return
+            self.peer_ids[peer_hash] = peer_id
+            self.topics_per_peer[peer_hash] = topics
+            for topic in topics:
+                index = self.peers_per_pattern if _is_pattern(
+                    topic) else self.peers_per_topic
+                index.setdefault(topic, set()).add(peer_hash)
+
+    def remove(self, peer_hash):
+        with self.lock:
+            self._remove(peer_hash)
+
+    def _remove(self, peer_hash):
+        self.targets.clear()
+        self.peer_ids.pop(peer_hash, None)
+        for topic in self.topics_per_peer.pop(peer_hash, ()):
+            index = self.peers_per_pattern if _is_pattern(
+                topic) else self.peers_per_topic
+            index[topic].discard(peer_hash)
+            if len(index[topic]) == 0:
+                del index[topic]
+
+    def subscribers(self, topic):
+        """ Returns the list of peer IDs subscribed to the topic. The list
+        is shared with later calls, do not change it. """
+        with self.lock:
+            peers = self.targets.get(topic, None)
+            if peers is None:
+                peers = self._match(topic)
+                if len(peers) > 0:
+                    if len(self.targets) >= self.cache_size:
+                        # Drop the oldest entry
+                        del self.targets[next(iter(self.targets))]
+                    self.targets[topic] = peers
+            return peers
+
+    def _match(self, topic):
+        peer_hashes = set(self.peers_per_topic.get(topic, ()))
+        for pattern, pattern_peers in self.peers_per_pattern.items():
+            if _topic_matches(pattern, topic):
+                peer_hashes |= pattern_peers
+        return [self.peer_ids[peer_hash] for peer_hash in peer_hashes]
+
+
+# Failure detection
+
+class _PhiAccrualDetector():
+    """ Keeps the recent intervals between heartbeats from a peer, and
+    estimates how likely it is that the peer has failed, given the time
+    since the last heartbeat. The estimate is expressed as phi, where phi 1
+    means about 10% chance of a mistake when suspecting the peer, phi 2
+    about 1% and so on. """
+
+    def __init__(self, interval, history=100):
+        self.intervals = deque([interval], maxlen=history)
+        self.min_deviation = interval/4
+        self.last = time.monotonic()
+
+    def heartbeat(self, learn=True):
+        now = time.monotonic()
+        if learn:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    def phi(self):
+        elapsed = time.monotonic() - self.last
+        mean = sum(self.intervals)/len(self.intervals)
+        variance = sum((interval - mean)**2
+            for interval in self.intervals)/len(self.intervals)
+        deviation = max(math.sqrt(variance), self.min_deviation)
+        # Logistic approximation of the normal distribution, in log form
+        # to avoid underflow for long silences
+        y = (elapsed - mean)/deviation
+        exponent = y*(1.5976 + 0.070566*y*y)
+        if y > 0:
+            return exponent/math.log(10) + math.log10(1 + math.exp(-exponent))
+        return -math.log10(1 - 1/(1 + math.exp(-max(exponent, -50))))
+
+
+# Rate control
+
+class _RateController():
+    """ Paces the data sent to one peer with a token bucket, and adjusts
+    the rate by additive increase and multiplicative decrease, based on the
+    round-trip time and short writes. """
+
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.rate = self.reported_rate = _INITIAL_RATE
+        self.tokens = self.rate*_PACING_BURST
+        self.updated = self.changed = time.monotonic()
+        self.srtt = self.min_rtt = None
+        self.min_rtt_at = 0
+        # Set when the rate was the limit, so the rate only grows if used
+        self.limited = False
+        # (data, size, send mode) waiting for the budget
+        self.queue = deque()
+        self.queued_bytes = 0
+
+    def allowance(self, now):
+        self.tokens = min(self.tokens + (now - self.updated)*self.rate,
+            self.rate*_PACING_BURST)
+        self.updated = now
+        if self.tokens <= 0:
+            self.limited = True
+        return self.tokens
+
+    def take(self, size, now):
+        """ Returns True if data of `size` bytes can be sent now. The
+        bucket can go into debt, so that large messages are not held
+        forever. """
+        if len(self.queue) > 0 or self.allowance(now) <= 0:
+            return False
+        self.tokens -= size
+        return True
+
+    def round_trip(self, rtt, now):
+        if self.min_rtt is None or rtt <= self.min_rtt or (
+                now - self.min_rtt_at > _MIN_RTT_WINDOW):
+            self.min_rtt, self.min_rtt_at = rtt, now
+        self.srtt = rtt if self.srtt is None else 0.875*self.srtt + 0.125*rtt
+        if self.srtt > self.min_rtt*_QUEUE_RTT_FACTOR + _QUEUE_RTT_MARGIN:
+            self.decrease(now)
+        elif self.limited:
+            self.rate = min(self.rate + _RATE_INCREASE, _MAX_RATE)
+        self.limited = False
+
+    def decrease(self, now):
+        """ Lowers the rate, at most once per round trip. """
+        if now - self.changed >= (self.srtt or 0):
+            self.rate = max(self.rate*_RATE_DECREASE, _MIN_RATE)
+            self.changed = now
+
+    def report(self):
+        """ Returns the rate if it has changed by 10% or more since the
+        last report, otherwise None. """
+        if abs(self.rate - self.reported_rate) < 0.1*self.reported_rate:
+            return None
+        self.reported_rate = self.rate
+        return self.rate
+
+
+# Resumable sessions
+
+class _PeerSession():
+    """ State kept per stable peer key when sessions are resumable, so
+    that it survives the peer dropping and reconnecting. """
+
+    def __init__(self, key, peer_id):
+        self.key = key
+        self.peer_id = peer_id
+        # Last sequence number received from the peer
+        self.received = 0
+        self.since_ack = 0
+        # (sequence number, data) sent to the peer and not acknowledged
+        self.unacked = deque()
+        # Sent data is only queued until the peer has sent its resume message
+        self.holding = True
+        self.resumed = False
+        self.resume_seq = 0
+        self.added = False
+        self.inviter = False
+        self.dropped_at = None
+        # Channel -> stream data not yet written when the peer dropped
+        self.channels = {}
+
+    def acknowledged(self, seq):
+        while len(self.unacked) > 0 and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+
+
+# Buffer payloads
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _buffer_header(view):
+    """ Returns the header sent before the memory of a memoryview, giving
+    its format and shape. """
+    fmt = view.format.encode()
+    return (_BUFFER_PREFIX + bytes([len(fmt), view.ndim]) + fmt +
+        struct.pack(f'>{view.ndim}I', *view.shape))
+
+
+class _py_buffer(Structure):
+    _fields_ = [('buf', c_void_p), ('obj', c_void_p),
+                ('len', ctypes.c_ssize_t), ('itemsize', ctypes.c_ssize_t),
+                ('readonly', c_int), ('ndim', c_int), ('format', c_char_p),
+                ('shape', c_void_p), ('strides', c_void_p),
+                ('suboffsets', c_void_p), ('internal', c_void_p)]
+
+
+# Buffer protocol access that also works for read-only objects like bytes
+# and the arrays given to buffer_receive, which ctypes from_buffer refuses
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_py_buffer), c_int]
+_get_buffer.restype = c_int
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = [ctypes.POINTER(_py_buffer)]
+_release_buffer.restype = None
+_PyBUF_SIMPLE = 0
+
+
+def _buffer_nsdata(header, payload):
+    """ Builds the NSData of a buffer message. The memory of `payload`, a
+    C-contiguous buffer-protocol object, is copied natively without
+    creating Python objects, also when it is read-only. """
+    payload_len = memoryview(payload).nbytes
+    data = NSMutableData.alloc().initWithCapacity_(len(header) + payload_len)
+    data.appendBytes_length_(header, len(header))
+    if payload_len > 0:
+        view = _py_buffer()
+        _get_buffer(payload, ctypes.byref(view), _PyBUF_SIMPLE)
+        try:
+            # The view holds the payload until NSData has its copy
+            data.appendBytes_length_(view.buf, payload_len)
+        finally:
+            _release_buffer(ctypes.byref(view))
+    return data
+
+
+def _decode_buffer(data):
+    """ Returns a NumPy array, or a memoryview if NumPy is not available or
+    does not know the format, that views the payload of a buffer message
+    without copying it. """
+    fmt_len, ndim = data[1], data[2]
+    fmt = bytes(data[3:3 + fmt_len]).decode()
+    offset = 3 + fmt_len
+    shape = struct.unpack_from(f'>{ndim}I', data, offset)
+    offset += 4*ndim
+    if numpy is not None:
+        try:
+            dtype = numpy.dtype(fmt)
+        except TypeError:
+            dtype = None
+        if dtype is not None:
+            return numpy.frombuffer(data, dtype, offset=offset).reshape(shape)
+    view = memoryview(data)[offset:]
+    try:
+        return view.cast(fmt, shape)
+    except (TypeError, ValueError):
+        return view
+
+
+# Typed messages
+
+# Messages sent with send_message start with this byte and the type ID
+_MESSAGE_PREFIX = b'\x04'
+_message_header = struct.Struct('>H')
+
+# Field annotation -> struct format character of fixed size fields
+_FIXED_FIELDS = {int: 'q', float: 'd', bool: '?'}
+_FIXED_FIELDS.update({t.__name__: f for t, f in _FIXED_FIELDS.items()})
+_FIXED_FIELDS.update({f: f for f in 'bBhHiIqQfd?'})
+# Annotations of fields sent as a length followed by the bytes
+_VARIABLE_FIELDS = {str: 'str', bytes: 'bytes', 'str': 'str',
+    'bytes': 'bytes'}
+
+# Type ID -> Message subclass
+message_types = {}
+
+
+class _MessageType(type):
+    """ Generates the slots, constructor, type ID and struct encoder and
+    decoder of a `Message` subclass from its field annotations, after the
+    fields of the message types it is derived from. """
+
+    def __new__(meta, name, bases, namespace):
+        annotations = namespace.get('__annotations__', {})
+        own_defaults = {field: namespace.pop(field) for field in annotations
+            if field in namespace}
+        inherited_slots = set(slot for base in bases for klass in base.__mro__
+            for slot in klass.__dict__.get('__slots__', ()))
+        namespace['__slots__'] = tuple(field for field in annotations
+            if field not in inherited_slots)
+        cls = super().__new__(meta, name, bases, namespace)
+        if not any(isinstance(base, _MessageType) for base in bases):
+            return cls
+
+        codes = {}
+        defaults = {}
+        for klass in reversed(cls.__mro__[1:]):
+            codes.update(klass.__dict__.get('_field_codes', ()))
+            defaults.update(klass.__dict__.get('_field_defaults', {}))
+        for field, annotation in annotations.items():
+            code = _FIXED_FIELDS.get(annotation, None) or \
+                _VARIABLE_FIELDS.get(annotation, None)
+            if code is None:
+                raise TypeError(f'Unsupported type for field {field} of '
+                    f'{name}: {annotation!r}')
+            codes[field] = code
+        defaults.update(own_defaults)
+        with_default = None
+        for field in codes:
+            if field in defaults:
+                with_default = field
+            elif with_default is not None:
+                raise TypeError(f'Field {field} of {name} has no default '
+                    f'value, but follows field {with_default}, which has one')
+        fields = list(codes.items())
+        cls._field_codes = tuple(fields)
+        cls._field_defaults = defaults
+        cls._fields = tuple(field for field, _ in fields)
+        cls.schema = f'{name}(' + ','.join(
+            f'{field}:{code}' for field, code in fields) + ')'
+        cls.type_id = zlib.crc32(cls.schema.encode()) & 0xffff
+        known = message_types.get(cls.type_id, None)
+        if known is not None and known.schema != cls.schema:
+            raise ValueError(f'Type ID of {cls.schema} is already used by '
+                f'{known.schema}, rename a field')
+        message_types[cls.type_id] = cls
+
+        fixed = [(field, code) for field, code in fields if len(code) == 1]
+        variable = [(field, code) for field, code in fields if len(code) > 1]
+        body = struct.Struct('>' + ''.join(code for _, code in fixed) +
+            'I'*len(variable))
+        scope = {'_header': _MESSAGE_PREFIX + _message_header.pack(
+            cls.type_id), '_body': body, '_cls': cls,
+            '_new': object.__new__, '_defaults': defaults}
+        args = ', '.join(
+            f'{field}=_defaults[{field!r}]' if field in defaults else field
+            for field in cls._fields)
+        lines = [f'def __init__(self, {args}):', '    pass'] + [
+            f'    self.{field} = {field}' for field in cls._fields] + ['']
+        lines.append('def encode(self):')
+        for i, (field, code) in enumerate(variable):
+            lines.append(f'    _v{i} = self.{field}' +
+                ('.encode()' if code == 'str' else ''))
+        lines.append('    return _header + _body.pack(' + ', '.join(
+            [f'self.{field}' for field, _ in fixed] +
+            [f'len(_v{i})' for i in range(len(variable))]) + ')' +
+            ''.join(f' + _v{i}' for i in range(len(variable))))
+        lines += ['', 'def decode(data):', '    self = _new(_cls)']
+        targets = [f'self.{field}' for field, _ in fixed] + [
+            f'_n{i}' for i in range(len(variable))]
+        if len(targets) > 0:
+            lines.append('    ' + ', '.join(targets) +
+                ', = _body.unpack_from(data, 3)')
+        if len(variable) > 0:
+            lines.append(f'    _o = {3 + body.size}')
+        for i, (field, code) in enumerate(variable):
+            lines.append(f'    self.{field} = bytes(data[_o:_o + _n{i}])' +
+                ('.decode()' if code == 'str' else ''))
+            lines.append(f'    _o += _n{i}')
+        lines.append('    return self')
+        exec('\n'.join(lines), scope)
+        cls.__init__ = scope['__init__']
+        cls.encode = scope['encode']
+        cls.decode = staticmethod(scope['decode'])
+        return cls
+
+
+class Message(metaclass=_MessageType):
+    """ Base class for typed messages, sent with `send_message` as compact
+    binary instead of JSON. Declare the fields with annotations:
+
+        class Move(multipeer.Message):
+            player: str
+            x: 'H'
+            y: 'H'
+            boost: bool = False
+
+    Fields can be `int` (64-bit), `float` (double), `bool`, `str` or
+    `bytes`, or a `struct` format character for a smaller number, like
+    `'B'` or `'H'`. Values that do not fit the type raise `struct.error`
+    when sent. Instances are created with the fields as arguments, in
+    order or by name, and take no memory for a `__dict__`.
+
+    A subclass of a message type has the fields of its base first,
+    followed by its own. Like with function arguments, fields without a
+    default value can not follow fields with one.
+
+    Each subclass gets a 16-bit `type_id` computed from its `schema`, the
+    class name and the names and types of the fields, so peers running
+    different versions of a message do not decode each other's data, and
+    an `encode` method that returns the message as bytes, type ID
+    included. """
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(
+            getattr(self, field) == getattr(other, field)
+            for field in self._fields)
+
+    def __repr__(self):
+        return type(self).__name__ + '(' + ', '.join(
+            f'{field}={getattr(self, field)!r}'
+            for field in self._fields) + ')'
+
+
+def decode_message(data):
+    """ Returns the message encoded in `data`, or None if the type ID is
+    not known. """
+    message_type = message_types.get(
+        _message_header.unpack_from(data, 1)[0], None)
+    return None if message_type is None else message_type.decode(data)
+
+
+# Session recording
+
+RECORD_SEND = 1
+RECORD_RECEIVE = 2
+RECORD_STREAM_SEND = 3
+RECORD_STREAM_RECEIVE = 4
+RECORD_PEER_ADDED = 5
+RECORD_PEER_REMOVED = 6
+RECORD_CHANNEL_SEND = 7
+RECORD_CHANNEL_RECEIVE = 8
+RECORD_BUFFER_SEND = 9
+RECORD_BUFFER_RECEIVE = 10
+RECORD_MESSAGE_SEND = 11
+RECORD_MESSAGE_RECEIVE = 12
+
+_log_magic = b'MCLOG1\n'
+# Timestamp, record type, peer hash, display name length, payload length
+_log_record = struct.Struct('<dBQHI')
+
+
+class Recorder():
+    """ Writes the traffic of a `MultipeerConnectivity` instance to an
+    append-only binary log. Usually created by calling `start_recording`.
+
+    Each record holds a monotonic timestamp in seconds since the start of
+    the recording, record type (one of the `RECORD_*` constants), hash and
+    display name of the peer, and the payload bytes. For added peers, the
+    payload is the JSON-encoded initial data of the peer. For named stream
+    channels, the payload starts with a byte giving the length of the
+    channel name, followed by the UTF-8 encoded name. Buffers and typed
+    messages are recorded as sent, header included. """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'wb')
+        self.file.write(_log_magic)
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, record_type, peer_id, payload=b''):
+        name = str(peer_id.displayName()).encode()
+        header = _log_record.pack(time.monotonic() - self.start, record_type,
+            peer_id.hash(), len(name), len(payload))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(name)
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_log(file_name):
+    """ Generator that yields the records of a log written by a `Recorder`
+    as (timestamp, record type, peer hash, display name, payload) tuples. """
+    with open(file_name, 'rb') as fp:
+        if fp.read(len(_log_magic)) != _log_magic:
+            raise ValueError('Not a multipeer log file', file_name)
+        while True:
+            header = fp.read(_log_record.size)
+            if len(header) < _log_record.size:
+                return
+            timestamp, record_type, peer_hash, name_len, payload_len = \
+                _log_record.unpack(header)
+            name = fp.read(name_len).decode()
+            payload = fp.read(payload_len)
+            yield timestamp, record_type, peer_hash, name, payload
+
+
+def _channel_payload(channel, byte_data):
+    name = channel.encode()
+    return bytes([len(name)]) + name + byte_data
+
+
+class _ReplayPeer():
+    """ Stands in for the peer ID of a recorded peer during a replay. """
+
+    def __init__(self, peer_hash, display_name):
+        self._hash = peer_hash
+        self.display_name = display_name
+
+    def hash(self):
+        return self._hash
+
+    def displayName(self):
+        return self.display_name
+
+
+def replay(file_name, target, speed=1.0):
+    """ Feeds a log written by a `Recorder` to `target`, an instance of a
+    `MultipeerConnectivity` subclass, by calling its `peer_added`,
+    `peer_removed`, `receive`, `stream_receive`, `channel_receive` and
+    `buffer_receive` methods, and the handlers of typed messages.
+
+    * `file_name` - log file to replay.
+    * `target` - object receiving the recorded events.
+    * `speed` - 1.0 replays with the original timing, 2.0 twice as fast and
+    so on. 0 replays without any delays.
+
+    Recorded outgoing traffic is skipped, and anything the target sends
+    for the duration of the replay is ignored, including `publish`, `call`
+    and `send_bulk` as well as `send`, `send_buffer`, `send_message` and
+    `stream`. Recorded peers are represented by objects that have the
+    `display_name` member and the `hash()` method. """
+    peers = {}
+    # The lowest layer of sending, below which nothing reaches the session
+    # or the streams, and the sending methods, which would otherwise record
+    # what the target sends
+    stubbed = ('_transmit', '_submit', 'send', 'send_buffer', 'send_message',
+        'stream')
+    originals = {name: target.__dict__[name] for name in stubbed
+        if name in target.__dict__}
+    for name in stubbed:
+        setattr(target, name, lambda *args, **kwargs: None)
+    try:
+        started = time.monotonic()
+        for timestamp, record_type, peer_hash, name, payload in read_log(
+                file_name):
+            peer_id = peers.setdefault(peer_hash, _ReplayPeer(peer_hash, name))
+            if speed > 0:
+                wait = started + timestamp/speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            if record_type == RECORD_RECEIVE:
+                target.receive(json.loads(payload.decode()), peer_id)
+            elif record_type == RECORD_BUFFER_RECEIVE:
+                target.buffer_receive(_decode_buffer(payload), peer_id)
+            elif record_type == RECORD_MESSAGE_RECEIVE:
+                target._dispatch_message(payload, peer_id)
+            elif record_type == RECORD_STREAM_RECEIVE:
+                target.stream_receive(bytearray(payload), peer_id)
+            elif record_type == RECORD_CHANNEL_RECEIVE:
+                name_end = payload[0] + 1
+                target.channel_receive(payload[1:name_end].decode(),
+                    bytearray(payload[name_end:]), peer_id)
+            elif record_type == RECORD_PEER_ADDED:
+                if len(payload) > 0:
+                    target.initial_peer_data[peer_hash] = json.loads(
+                        payload.decode())
+                target.peer_added(peer_id)
+            elif record_type == RECORD_PEER_REMOVED:
+                target.peer_removed(peer_id)
+    finally:
+        for name in stubbed:
+            delattr(target, name)
+        target.__dict__.update(originals)
+
+
+# Tracing
+
+class Tracer():
+    """ Keeps the most recent timed spans of the traffic of a
+    `MultipeerConnectivity` instance in memory, at most `max_spans` of
+    them. Usually created by calling `start_tracing`.
+
+    Each span is a tuple of name, start and end time in seconds since the
+    epoch, message ID or None, thread name and a dict of details or None.
+    Messages sent with `send`, `send_buffer` and `send_message` get an ID
+    that travels with the message, and these spans:
+
+    * `encode` - converting the message to bytes.
+    * `queue` - waiting for the sending thread or the rate limit.
+    * `bridge` - handing the data to the framework.
+    * `receive` - getting the data from the framework, on the receiving
+    peer.
+    * `decode` - converting the bytes back to a message.
+    * `handler` - the callback or handler that got the message.
+
+    Streams get `stream write`, `stream read` and `stream handler` spans
+    with the channel name instead. """
+
+    def __init__(self, name, max_spans=10000):
+        self.name = name
+        self.spans = deque(maxlen=max_spans)
+        # Message IDs are unique across peers without coordination
+        self.origin = uuid.uuid4().int & 0xffffffff
+        self.pid = self.origin & 0x7fffffff
+        self._ids = itertools.count(1)
+
+    def next_id(self):
+        return self.origin << 32 | next(self._ids)
+
+    def span(self, name, start, msg_id=None, end=None, **details):
+        self.spans.append((name, start, time.time() if end is None else end,
+            msg_id, threading.current_thread().name, details or None))
+
+    def call(self, name, msg_id, func, *args):
+        """ Returns `func(*args)`, recording the time it took as a span. """
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.span(name, start, msg_id)
+
+    def export(self, file_name=None):
+        """ Returns the spans as a dict in the Chrome Trace Event format,
+        which can be opened in `chrome://tracing` or Perfetto, and writes it
+        to `file_name` as JSON if given. Spans of the same message are
+        connected with flow arrows from `bridge` to `receive`. """
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': self.pid,
+            'tid': 0, 'args': {'name': self.name}}]
+        threads = {}
+        for name, start, end, msg_id, thread, details in list(self.spans):
+            tid = threads.setdefault(thread, len(threads) + 1)
+            event = {'name': name, 'cat': 'multipeer', 'ph': 'X',
+                'pid': self.pid, 'tid': tid, 'ts': start*1e6,
+                'dur': (end - start)*1e6}
+            args = dict(details or {})
+            if msg_id is not None:
+                args['message'] = f'{msg_id:x}'
+            if len(args) > 0:
+                event['args'] = args
+            events.append(event)
+            if msg_id is not None and name in ('bridge', 'receive'):
+                flow = {'name': 'message', 'cat': 'multipeer',
+                    'id': args['message'], 'pid': self.pid, 'tid': tid,
+                    'ts': event['ts']}
+                if name == 'bridge':
+                    flow['ph'] = 's'
+                else:
+                    flow['ph'] = 'f'
+                    flow['bp'] = 'e'
+                events.append(flow)
+        events.extend({'ph': 'M', 'name': 'thread_name', 'pid': self.pid,
+            'tid': tid, 'args': {'name': thread}}
+            for thread, tid in threads.items())
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if file_name is not None:
+            with open(file_name, 'w') as fp:
+                json.dump(trace, fp)
+        return trace
+
+
+def merge_traces(traces, file_name=None, align=True):
+    """ Combines traces exported from several peers of a session into one
+    timeline. Returns the combined trace and writes it to `file_name` as
+    JSON if given.
+
+    * `traces` - dicts returned by `export_trace`, or names of the files
+    they were written to.
+    * `file_name` - optional file to write the combined trace to.
+    * `align` - if True, the clocks of the other peers are aligned with
+    the first one. As in NTP, the fastest message each way between two
+    peers is assumed to have taken equally long, so this needs traced
+    messages in both directions. Peers without them are left as they are.
+    """
+    loaded = []
+    for trace in traces:
+        if isinstance(trace, str):
+            with open(trace) as fp:
+                trace = json.load(fp)
+        loaded.append(trace['traceEvents'])
+    if align:
+        sends, receives = {}, {}
+        for index, events in enumerate(loaded):
+            for event in events:
+                if event['ph'] == 's':
+                    sends[event['id']] = (index, event['ts'])
+                elif event['ph'] == 'f':
+                    receives.setdefault(event['id'], []).append(
+                        (index, event['ts']))
+        # Smallest apparent one-way delay between each pair of traces
+        delays = {}
+        for msg_id, (sender, sent) in sends.items():
+            for receiver, received in receives.get(msg_id, ()):
+                pair = (sender, receiver)
+                delays[pair] = min(delays.get(pair, math.inf), received - sent)
+        for index in range(1, len(loaded)):
+            if (0, index) not in delays or (index, 0) not in delays:
+                continue
+            offset = (delays[(0, index)] - delays[(index, 0)])/2
+            loaded[index] = [dict(event, ts=event['ts'] - offset)
+                if 'ts' in event else event for event in loaded[index]]
+    trace = {'traceEvents': [event for events in loaded for event in events],
+        'displayTimeUnit': 'ms'}
+    if file_name is not None:
+        with open(file_name, 'w') as fp:
+            json.dump(trace, fp)
+    return trace
+
+
+def _print_job_error(future):
+    """ Prints the error of a writer job that nobody waited for. """
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
   
   # Wrapper class
   
@@ -328,13 +1382,46 @@ class MultipeerConnectivity():
     peers with a call to `get_initial_data()`.
     * `initialize_streams` - If True, a stream is set up to any peer that
     connects.
+    * `discovery_info` - Optional dict of strings published to browsing
+    peers before they connect, e.g. app version, role or capacity. Keep it
+    small, preferably under 400 bytes in total. See `admit_peer`.
+    * `max_concurrent_invites` - If set, at most this many invitations are
+    pending at a time, and further peers wait in a queue. Limits the
+    handshake traffic in crowded environments.
+    * `invite_timeout` - Seconds to wait for an invited peer to respond. 0
+    uses the framework default of 30 seconds.
+    * `invite_mode` - With the default `'mutual'`, every peer invites every
+    other peer it finds. With `'single'`, only one peer of each pair sends
+    the invitation, which halves the invitation traffic and makes the
+    session form faster. All peers need to use the same mode.
+    * `encryption` - `'required'` (default), `'optional'` or `'none'`.
+    Dropping encryption reduces latency and CPU use, but only use it on
+    networks you trust. Peers with `'required'` and `'none'` can not
+    connect with each other.
+    * `security_identity` - Optional list with a `SecIdentityRef` followed
+    by any certificates, used to identify this peer to others.
+    * `heartbeat_interval` - If set, seconds between heartbeats sent to
+    every peer, used to detect failed peers quickly. All peers need to use
+    heartbeats. See `peer_suspected`.
+    * `resume_timeout` - If set, seconds to keep the session of a peer
+    that dropped while trying to reconnect to it. See `peer_resumed`. All
+    peers need to use the same value.
+    * `rate_control` - If True, data sent to each peer is paced to a rate
+    adjusted to what the link can carry. See `get_send_budget`.
+    * `phi_threshold` - Suspicion level at which a silent peer is reported
+    with `peer_suspected`. With regular heartbeats, the default of 8 is
+    reached after a silence of about two and a half intervals.
 
     Created object will immediately start advertising and browsing for peers.
     """
 
 
     def __init__(self, display_name='Peer', service_type='dev-srv',
-            initial_data=None, initialize_streams=False):
+            initial_data=None, initialize_streams=False, discovery_info=None,
+            max_concurrent_invites=None, invite_timeout=0,
+            invite_mode='mutual', encryption='required',
+            security_identity=None, heartbeat_interval=None,
+            phi_threshold=8.0, resume_timeout=None, rate_control=False):
         global mc_managers
     
         if display_name is None or display_name == '' or len(
@@ -351,21 +1438,94 @@ class MultipeerConnectivity():
             raise ValueError(
                 'service_type must be 1-15 characters long and can contain only '
                 'ASCII lowercase letters, numbers and hyphens', service_type)
+        if invite_mode not in ('mutual', 'single'):
+            raise ValueError("invite_mode must be 'mutual' or 'single'",
+                invite_mode)
+        if encryption not in ENCRYPTION_PREFERENCES:
+            raise ValueError(
+                "encryption must be 'required', 'optional' or 'none'",
+                encryption)
     
         self.my_id = MCPeerID.alloc().initWithDisplayName(display_name)
         self.my_id.display_name = str(self.my_id.displayName())
     
         self.initial_data = initial_data
         self.initial_peer_data = {}
-        self._peer_connection_hit_count = {}
-    
-        mc_managers[self.my_id.hash()] = self
+        self.peer_states = {}
+        self._handshaken_peers = set()
+        self.invite_mode = invite_mode
+        self.peer_token = uuid.uuid4().hex
+        self._control_handlers = {
+            'hello': self._receive_hello,
+            'bulk_ack': self._receive_bulk_ack,
+            'subscriptions': self._receive_subscriptions,
+            'publish': self._receive_publication,
+            'call': self._receive_call,
+            'result': self._receive_result,
+            'hb': self._receive_heartbeat,
+            'resume': self._receive_resume,
+            'ack': self._receive_ack,
+            'ping': self._receive_ping,
+            'pong': self._receive_pong,
+            'schema': self._receive_schema,
+        }
+        self._message_handlers = {}
     
         self.initialize_streams = initialize_streams
         self.outputstream_per_peer = {}
-        self.peer_per_inputstream = {}
+        self.pending_per_outputstream = {}
+        self.inputstreams = {}
+        self._peer_ids = {}
+        self.channel_limits = {}
+        self._bulk_transfer_ids = itertools.count(1)
+        self._bulk_transfers = {}
+        self._stripe_counts = {}
+        self._stripe_rates = {}
+        self._stripe_buffers = {}
+        self._incoming_bulk = {}
+        self.subscriptions = set()
+        self._topic_index = _TopicIndex()
+        self._call_handlers = {}
+        self._call_count = 0
+        self._pending_calls = {}
+        self._call_lock = threading.Lock()
+        self.heartbeat_interval = heartbeat_interval
+        self.phi_threshold = phi_threshold
+        self._heartbeats = {}
+        self._suspected_peers = set()
+        self._heartbeat_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.resume_timeout = resume_timeout
+        self.peer_key = uuid.uuid4().hex
+        self._peer_keys = {}
+        self._discovered_keys = {}
+        self._peer_sessions = {}
+        self._send_seq = 0
+        self._resume_lock = threading.Lock()
+        self.rate_control = rate_control
+        self._rate_controllers = {}
+        self._paced_streams = set()
+        self._rate_lock = threading.Lock()
+        self._pacing_wakeup = threading.Event()
+        self._outbox = deque()
+        self._writer_lock = threading.Lock()
+        self._writer = None
+        self._rate_reports = deque()
+        self.recorder = None
+        self.tracer = None
+    
+        self.max_concurrent_invites = max_concurrent_invites
+        self.invite_timeout = invite_timeout
+        self.pending_invites = {}
+        self.invite_queue = deque()
+        self.connect_times = deque(maxlen=100)
     
-        self.session = MCSession.alloc().initWithPeer_(self.my_id)
+        self.encryption = encryption
+        self.session = MCSession.alloc().\
+            initWithPeer_securityIdentity_encryptionPreference_(
+                self.my_id,
+                None if security_identity is None else ns(security_identity),
+                ENCRYPTION_PREFERENCES[encryption])
         self.session.setDelegate_(SDelegate)
     
         # Create browser and set delegate
@@ -374,11 +1534,26 @@ class MultipeerConnectivity():
         self.browser.setDelegate_(Bdelegate)
     
         # Create advertiser and set delegate
+        discovery_info = dict(discovery_info or {})
+        if invite_mode == 'single':
+            discovery_info[_TOKEN_KEY] = self.peer_token
+        if resume_timeout is not None:
+            discovery_info[_PEER_KEY] = self.peer_key
         self.advertiser = MCNearbyServiceAdvertiser.alloc().\
             initWithPeer_discoveryInfo_serviceType_(
-                self.my_id, ns({}), self.service_type)
+                self.my_id, ns(discovery_info), self.service_type)
         self.advertiser.setDelegate_(ADelegate)
     
+        with _registry_lock:
+            for manager_object in (self.session, self.browser,
+                    self.advertiser):
+                mc_managers[_pointer(manager_object)] = self
+    
+        if heartbeat_interval is not None:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        if rate_control:
+            threading.Thread(target=self._pacing_loop, daemon=True).start()
+    
         self.start_looking_for_peers()
     
     
@@ -393,6 +1568,95 @@ class MultipeerConnectivity():
         print('Removed peer', peer_id.display_name)
     
     
+    def peer_resumed(self, peer_id):
+        """ Override in a subclass to react to a peer that reconnected
+        within `resume_timeout`. Messages that the peer missed are sent
+        again, so application state does not need to be rebuilt. """
+        print('Resumed peer', peer_id.display_name)
+    
+    
+    def peer_suspected(self, peer_id):
+        """ Override in a subclass to react to a peer that has stopped
+        sending heartbeats, e.g. by not waiting for its input. The peer may
+        still recover or be removed later. Called on a background thread.
+        """
+        print('Suspected peer', peer_id.display_name)
+    
+    
+    def peer_recovered(self, peer_id):
+        """ Override in a subclass to react to heartbeats arriving again
+        from a suspected peer. """
+        print('Recovered peer', peer_id.display_name)
+    
+    
+    def rate_changed(self, peer_id, rate):
+        """ Override in a subclass to adjust how much is sent to the peer
+        when the rate limit, in bytes per second, has changed by 10% or
+        more. Only called with `rate_control`. """
+        pass
+    
+    
+    def get_send_budget(self, peer_id):
+        """ Returns a dict with the current rate limit for the peer in
+        bytes per second (`rate`), the number of bytes queued waiting for
+        the budget (`queued`) and the smoothed round-trip time in seconds
+        (`rtt`, None until measured). Returns None without `rate_control`
+        or for unknown peers. """
+        with self._rate_lock:
+            controller = self._rate_controllers.get(peer_id.hash(), None)
+            if controller is None:
+                return None
+            return {
+                'rate': controller.rate,
+                'queued': controller.queued_bytes,
+                'rtt': controller.srtt,
+            }
+    
+    
+    def is_suspected(self, peer_id):
+        """ Returns True if the peer has been reported with
+        `peer_suspected` and has not recovered since. """
+        return peer_id.hash() in self._suspected_peers
+    
+    
+    def admit_peer(self, peer_id, discovery_info):
+        """ Override in a subclass to decide whether to invite a peer that
+        was found. `discovery_info` is the dict the peer published, or None.
+        Return False to skip the peer. Called for every peer found, so keep
+        it fast. """
+        return True
+    
+    
+    def accept_peer(self, peer_id, initial_data):
+        """ Override in a subclass to decide whether to accept an
+        invitation from a peer. `initial_data` is the initial data of the
+        peer, or None. Return False to decline. """
+        return True
+    
+    
+    def get_peer_state(self, peer_id):
+        """ Returns the connection state of the peer: `'invited'` while an
+        invitation is being processed, `'connected'` when the session is
+        connected but the peer has not yet been passed to `peer_added`,
+        `'added'` after that, `'dropped'` while waiting for a resumable peer
+        to reconnect, or None for unknown and disconnected peers. """
+        return self.peer_states.get(peer_id.hash(), None)
+    
+    
+    def get_connection_metrics(self):
+        """ Returns a dict with the number of invitations pending and
+        queued, and the count, mean and maximum of the recent times from
+        invitation to connection, in seconds. """
+        times = list(self.connect_times)
+        return {
+            'pending_invites': len(self.pending_invites),
+            'queued_invites': len(self.invite_queue),
+            'connections': len(times),
+            'mean_connect_time': sum(times)/len(times) if times else None,
+            'max_connect_time': max(times) if times else None,
+        }
+    
+    
     def get_peers(self):
         ''' Get a list of peers currently connected. '''
         peer_list = []
@@ -439,15 +1703,112 @@ class MultipeerConnectivity():
         else:
             peers = [to_peer]
     
+        tracer = self.tracer
+        started = time.time()
         message = json.dumps(message)
         message = message.encode()
+        if self.recorder is not None:
+            for peer_id in peers:
+                self.recorder.write(RECORD_SEND, peer_id, message)
+    
+        msg_id = None
+        if tracer is not None:
+            msg_id = tracer.next_id()
+            tracer.span('encode', started, msg_id)
+            message = _TRACED_PREFIX + _trace_header.pack(msg_id) + message
+        self._send_data(message, peers, reliable, broadcast=to_peer is None,
+            msg_id=msg_id)
+    
+    
+    def send_buffer(self, buffer, to_peer=None, reliable=True):
+        """ Send a NumPy array, memoryview or other object supporting the
+        buffer protocol to some or all peers, without converting it to
+        Python objects. Receiving peers get it with `buffer_receive`.
+    
+        * `buffer` - data to be sent. Arrays that are not C-contiguous are
+        copied first.
+        * `to_peer` - as with `send`.
+        * `reliable` - as with `send`.
+    
+        In resumable sessions, reliable buffers are copied to be kept for a
+        possible replay, so the caller can reuse the buffer right away.
+        """
+        if type(to_peer) == list:
+            peers = to_peer
+        elif to_peer is None:
+            peers = self.get_peers()
+        else:
+            peers = [to_peer]
+    
+        tracer = self.tracer
+        started = time.time()
+        view = memoryview(buffer)
+        header = _buffer_header(view)
+        payload = view if view.c_contiguous else view.tobytes()
+        if self.recorder is not None:
+            for peer_id in peers:
+                self.recorder.write(RECORD_BUFFER_SEND, peer_id,
+                    header + payload)
+    
+        msg_id = None
+        if tracer is not None:
+            msg_id = tracer.next_id()
+            tracer.span('encode', started, msg_id)
+            header = _TRACED_PREFIX + _trace_header.pack(msg_id) + header
+        if self.resume_timeout is not None and reliable:
+            self._send_data(header + payload, peers, reliable,
+                broadcast=to_peer is None, msg_id=msg_id)
+            return
+        self._transmit(_buffer_nsdata(header, payload), peers,
+            0 if reliable else 1, size=len(header) + memoryview(payload).nbytes,
+            msg_id=msg_id)
     
-        send_mode = 0 if reliable else 1
-        self.session.sendData_toPeers_withMode_error_(message, peers, send_mode,
-            None)
     
+    def send_message(self, message, to_peer=None, reliable=True):
+        """ Send a typed message, an instance of a `Message` subclass, to
+        some or all peers. Receiving peers pass it to the handler set with
+        `handle`, or to `message_receive`.
     
-    def stream(self, byte_data, to_peer=None):
+        * `message` - message to be sent.
+        * `to_peer` - as with `send`.
+        * `reliable` - as with `send`.
+        """
+        if type(to_peer) == list:
+            peers = to_peer
+        elif to_peer is None:
+            peers = self.get_peers()
+        else:
+            peers = [to_peer]
+    
+        tracer = self.tracer
+        started = time.time()
+        data = message.encode()
+        if self.recorder is not None:
+            for peer_id in peers:
+                self.recorder.write(RECORD_MESSAGE_SEND, peer_id, data)
+    
+        msg_id = None
+        if tracer is not None:
+            msg_id = tracer.next_id()
+            tracer.span('encode', started, msg_id)
+            data = _TRACED_PREFIX + _trace_header.pack(msg_id) + data
+        self._send_data(data, peers, reliable, broadcast=to_peer is None,
+            msg_id=msg_id)
+    
+    
+    def handle(self, message_type, handler):
+        """ Call `handler` with the message and the sending peer ID for
+        every received message of the `Message` subclass `message_type`,
+        instead of `message_receive`. Handlers run on the thread that
+        receives the message. `None` as the handler removes it. """
+        if handler is None:
+            self._message_handlers.pop(message_type.type_id, None)
+        else:
+            self._message_handlers[message_type.type_id] = (
+                message_type.decode, handler)
+    
+    
+    def stream(self, byte_data, to_peer=None, channel=None):
         """ Stream message string to some or all peers. Stream per receiver will
         be set up on first call. See constructor parameters for the option to have
         streams per peer initialized on connection.
@@ -456,6 +1817,14 @@ class MultipeerConnectivity():
         string, call its `encode()` method and pass the result to this method.
         * `to_peer` - receiver peer IDs. Can be a single peer ID, a list of peer
         IDs, or left out (None) for sending to all connected peers.
+        * `channel` - optional name of a separate stream to use. Receiving
+        peers get the data with the `channel_receive` callback instead of
+        `stream_receive`.
+    
+        Data that can not be written immediately is buffered and written when
+        the stream has space. Returns False if the data was dropped for one
+        or more peers because the channel buffer limit was reached, otherwise
+        True. Can be called from any thread.
         """
         if type(to_peer) == list:
             peers = to_peer
@@ -463,35 +1832,292 @@ class MultipeerConnectivity():
             peers = self.get_peers()
         else:
             peers = [to_peer]
+        channel = channel or DEFAULT_STREAM
+        limit = self.channel_limits.get(channel, None)
+        accepted = True
+        # Copied, as the caller may reuse the buffer before it is written
+        byte_data = bytes(byte_data)
         for peer_id in peers:
             peer_id = ObjCInstance(peer_id)
-            stream = self.outputstream_per_peer.get(peer_id.hash(), None)
-            if stream is None:
-                stream = self._set_up_stream(peer_id)
-            data_len = len(byte_data)
-            wrote_len = stream.write_maxLength_(byte_data, data_len)
-            if wrote_len != data_len:
-                print(f'Error writing data, wrote {wrote_len}/{data_len} bytes')
+            pending = self.pending_per_outputstream.get(
+                (peer_id.hash(), channel), None)
+            if (limit is not None and pending is not None and
+                    len(pending) + len(byte_data) > limit):
+                accepted = False
+                continue
+            if self.recorder is not None:
+                if channel == DEFAULT_STREAM:
+                    self.recorder.write(RECORD_STREAM_SEND, peer_id, byte_data)
+                else:
+                    self.recorder.write(RECORD_CHANNEL_SEND, peer_id,
+                        _channel_payload(channel, byte_data))
+            self._submit(self._write_stream, peer_id, channel, byte_data)
+        return accepted
+    
+    
+    def send_bulk(self, byte_data, to_peer, stripes=None):
+        """ Send a large payload to a single peer, split over several
+        streams that are used in parallel. The receiving peer gets the
+        payload in one piece with the `bulk_receive` callback.
+    
+        * `byte_data` - data to be sent.
+        * `to_peer` - receiver peer ID.
+        * `stripes` - number of streams to use. By default, the number is
+        chosen between 1 and `MAX_STRIPES` based on the throughput of
+        earlier transfers to the same peer.
+        """
+        peer_hash = to_peer.hash()
+        if stripes is None:
+            stripes = self._stripe_counts.get(peer_hash, 1)
+        transfer_id = next(self._bulk_transfer_ids)
+        self._bulk_transfers[transfer_id] = (peer_hash, stripes)
+        data = memoryview(byte_data)
+        count = max(1, -(-len(data) // _STRIPE_SEGMENT_SIZE))
+        for seq in range(count):
+            segment = data[seq*_STRIPE_SEGMENT_SIZE:(seq+1)*_STRIPE_SEGMENT_SIZE]
+            header = _stripe_header.pack(transfer_id, seq, count, len(segment))
+            self.stream(header + segment, to_peer,
+                channel=_STRIPE_CHANNEL + str(seq % stripes))
+    
+    
+    def subscribe(self, topic):
+        """ Start receiving messages published to the topic, which can
+        contain `+` and `#` wildcards. """
+        if topic not in self.subscriptions:
+            self.subscriptions.add(topic)
+            self._announce_subscriptions(self.get_peers())
+    
+    
+    def unsubscribe(self, topic):
+        """ Stop receiving messages published to the topic. """
+        if topic in self.subscriptions:
+            self.subscriptions.discard(topic)
+            self._announce_subscriptions(self.get_peers())
+    
+    
+    def publish(self, topic, message, reliable=True):
+        """ Send a message to the peers subscribed to the topic. Does
+        nothing if there are no subscribers.
+    
+        * `topic` - topic string, without wildcards.
+        * `message` - to be sent to the peer(s). Must be JSON-serializable.
+        * `reliable` - as with `send`.
+        """
+        peers = self._topic_index.subscribers(topic)
+        if len(peers) > 0:
+            self._send_control({
+                'type': 'publish',
+                'topic': topic,
+                'message': message,
+            }, peers, reliable)
+    
+    
+    def get_subscribers(self, topic):
+        """ Returns a list of the peers subscribed to the topic. """
+        return list(self._topic_index.subscribers(topic))
+    
+    
+    def register(self, name, handler):
+        """ Make `handler` callable by other peers with `call`. The handler
+        is called with the call arguments and the calling peer ID, and its
+        JSON-serializable return value is sent back as the result. Handlers
+        run on the thread that receives the message, so keep them short.
+        `None` as the handler removes a registration. """
+        if handler is None:
+            self._call_handlers.pop(name, None)
+        else:
+            self._call_handlers[name] = handler
+    
+    
+    def call(self, peer_id, name, args=None, timeout=None):
+        """ Call a handler registered by a peer, without waiting for the
+        result. Returns a `concurrent.futures.Future` that receives the
+        result, or an `RPCError` if the remote handler failed.
+    
+        * `peer_id` - peer to call.
+        * `name` - name the handler was registered with.
+        * `args` - JSON-serializable arguments for the handler.
+        * `timeout` - seconds after which the future fails with a
+        `concurrent.futures.TimeoutError`. Default is to wait until the peer
+        disconnects.
+    
+        Cancelling the future discards the result when it arrives.
+        """
+        future = concurrent.futures.Future()
+        with self._call_lock:
+            self._call_count += 1
+            call_id = self._call_count
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, self._finish_call,
+                    (call_id, None, concurrent.futures.TimeoutError(
+                        f'No result for {name} in {timeout} seconds')))
+                timer.daemon = True
+            self._pending_calls[call_id] = (future, peer_id.hash(), timer)
+        future.add_done_callback(
+            lambda future: future.cancelled() and self._finish_call(call_id))
+        if timer is not None:
+            timer.start()
+        self._send_control({
+            'type': 'call',
+            'id': call_id,
+            'name': name,
+            'args': args,
+        }, [peer_id])
+        return future
+    
+    
+    def set_channel_limit(self, channel, max_bytes):
+        """ Limit the amount of data buffered per peer for the channel.
+        Data that would exceed the limit is dropped by `stream`, which suits
+        e.g. telemetry where only recent data matters. `None` as the channel
+        sets the limit for the default stream, and `None` as `max_bytes`
+        removes the limit. """
+        channel = channel or DEFAULT_STREAM
+        if max_bytes is None:
+            self.channel_limits.pop(channel, None)
+        else:
+            self.channel_limits[channel] = max_bytes
+    
     
+    def get_stream_backlog(self, peer_id, channel=None):
+        """ Returns the number of bytes waiting to be written to the peer on
+        the channel. """
+        return len(self.pending_per_outputstream.get(
+            (peer_id.hash(), channel or DEFAULT_STREAM), b''))
     
-    def _set_up_stream(self, to_peer):
+    
+    def _set_up_stream(self, to_peer, channel=DEFAULT_STREAM):
         output_stream = ObjCInstance(
-            self.session.startStreamWithName_toPeer_error_('stream', to_peer,
+            self.session.startStreamWithName_toPeer_error_(channel, to_peer,
                 None))
         output_stream.setDelegate_(SDelegate)
         output_stream.scheduleInRunLoop_forMode_(NSRunLoop.mainRunLoop(),
             NSDefaultRunLoopMode)
     
         output_stream.open()
-        self.outputstream_per_peer[to_peer.hash()] = output_stream
+        key = (to_peer.hash(), channel)
+        with _registry_lock:
+            self.outputstream_per_peer[key] = output_stream
+            self.pending_per_outputstream[key] = bytearray()
+            mc_outputstream_managers[_pointer(output_stream)] = (self, key)
         return output_stream
     
     
+    def _write_stream(self, peer_id, channel, byte_data):
+        """ Writer job that buffers data for the stream to the peer on the
+        channel, setting the stream up if needed, and writes what fits. """
+        key = (peer_id.hash(), channel)
+        if key not in self.outputstream_per_peer:
+            session = self._session_for(peer_id)
+            if session is not None and session.dropped_at is not None:
+                # Written when the peer reconnects
+                session.channels[channel] = session.channels.get(
+                    channel, b'') + byte_data
+                return
+            self._set_up_stream(peer_id, channel)
+        if len(byte_data) > 0:
+            self.pending_per_outputstream[key].extend(byte_data)
+            self._flush_stream(key)
+    
+    
+    def _save_streams(self, peer_hash, session):
+        """ Writer job that keeps the data not yet written to the streams
+        of a dropped peer in its session. """
+        session.channels = { key[1]: bytes(pending) for key, pending
+            in self.pending_per_outputstream.items() if key[0] == peer_hash }
+    
+    
+    def _restore_streams(self, peer_id, session):
+        """ Writer job that sets up the streams of a resumed peer again
+        and writes what was kept. """
+        channels, session.channels = session.channels, {}
+        for channel, pending in channels.items():
+            self._write_stream(peer_id, channel, pending)
+    
+    
+    def _close_streams(self, peer_hash):
+        """ Writer job that closes the output streams to a peer. """
+        with _registry_lock:
+            keys = [key for key in self.outputstream_per_peer
+                if key[0] == peer_hash]
+            streams = []
+            for key in keys:
+                stream = self.outputstream_per_peer.pop(key)
+                self.pending_per_outputstream.pop(key, None)
+                mc_outputstream_managers.pop(_pointer(stream), None)
+                streams.append(stream)
+        for stream in streams:
+            _close_stream(stream)
+    
+    
+    def _flush_stream(self, key):
+        """ Writer job that writes buffered data to the stream as far as it
+        has space. """
+        stream = self.outputstream_per_peer.get(key, None)
+        if stream is None:
+            # Closed after the job was submitted
+            return
+        pending = self.pending_per_outputstream[key]
+        controller = self._rate_controllers.get(key[0], None)
+        started = time.time()
+        written = 0
+        paced = False
+        while len(pending) > 0 and stream.hasSpaceAvailable():
+            size = 65536
+            if controller is not None:
+                with self._rate_lock:
+                    allowance = controller.allowance(time.monotonic())
+                if allowance < 1:
+                    # Flushed again by the pacing thread
+                    with self._rate_lock:
+                        self._paced_streams.add(key)
+                    self._pacing_wakeup.set()
+                    paced = True
+                    break
+                size = min(size, int(allowance))
+            chunk = bytes(pending[:size])
+            wrote_len = stream.write_maxLength_(chunk, len(chunk))
+            if wrote_len < 0:
+                print(f'Error writing data, dropped {len(pending)} bytes')
+                pending.clear()
+                break
+            if controller is not None:
+                with self._rate_lock:
+                    controller.tokens -= wrote_len
+            if wrote_len == 0:
+                break
+            del pending[:wrote_len]
+            written += wrote_len
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.span('stream write', started, channel=key[1],
+                bytes=written)
+        if controller is not None and len(pending) > 0 and not paced:
+            # Link is not keeping up
+            self._congestion(key[0])
+    
+    
     def receive(self, message, from_peer):
         """ Override in a subclass to handle incoming messages. """
         print('Message from', from_peer.display_name, '-', message)
     
     
+    def message_receive(self, message, from_peer):
+        """ Override in a subclass to handle typed messages that have no
+        handler set with `handle`. """
+        print('Message from', from_peer.display_name, '-', message)
+    
+    
+    def schema_mismatch(self, peer_id, names):
+        """ Override in a subclass to react to a peer that declares the
+        listed `Message` classes with different fields, e.g. by asking the
+        user to update the app. Messages of these types from the peer are
+        not understood. """
+        print('Peer', peer_id.display_name, 'has different schema for',
+            ', '.join(names))
+    
+    
     def stream_receive(self, byte_data, from_peer):
         """ Override in a subclass to handle incoming streamed data.
         `byte_data` is a `bytearray`; call its `decode()` method if you expect a
@@ -499,6 +2125,76 @@ class MultipeerConnectivity():
         print('Message from', from_peer.display_name, '-', byte_data.decode())
     
     
+    def channel_receive(self, channel, byte_data, from_peer):
+        """ Override in a subclass to handle data streamed on a named
+        channel. `byte_data` is a `bytearray`. """
+        print('Message from', from_peer.display_name, 'on', channel, '-',
+            byte_data.decode())
+    
+    
+    def topic_receive(self, topic, message, from_peer):
+        """ Override in a subclass to handle messages published to topics
+        you have subscribed to. """
+        print('Message from', from_peer.display_name, 'on', topic, '-',
+            message)
+    
+    
+    def buffer_receive(self, buffer, from_peer):
+        """ Override in a subclass to handle buffers sent with
+        `send_buffer`. `buffer` is a read-only NumPy array with the sent
+        dtype and shape, or a memoryview if NumPy is not available. Copy it
+        if you need to change it. """
+        print('Buffer from', from_peer.display_name, '-', buffer.shape)
+    
+    
+    def bulk_receive(self, byte_data, from_peer):
+        """ Override in a subclass to handle payloads sent with `send_bulk`.
+        `byte_data` is a `bytes` object. """
+        print('Bulk data from', from_peer.display_name, '-', len(byte_data),
+            'bytes')
+    
+    
+    def start_recording(self, file_name):
+        """ Start writing all sent and received messages, streamed data and
+        added and removed peers to a binary log file. Any earlier contents
+        of the file are replaced. See `replay` for using the log. """
+        self.stop_recording()
+        self.recorder = Recorder(file_name)
+    
+    
+    def stop_recording(self):
+        """ Stop recording and close the log file. """
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+    
+    
+    def start_tracing(self, max_spans=10000):
+        """ Start recording timed spans of the sent and received messages
+        and streamed data, keeping the most recent `max_spans` of them. See
+        `Tracer` for the spans and `export_trace` for viewing them.
+    
+        Messages sent while tracing carry an 8-byte message ID, so that the
+        spans of a message can be followed from one peer to another. """
+        self.tracer = Tracer(self.my_id.display_name, max_spans)
+    
+    
+    def stop_tracing(self):
+        """ Stop tracing. Returns the `Tracer` with the spans recorded so
+        far, or None if not tracing. """
+        tracer, self.tracer = self.tracer, None
+        return tracer
+    
+    
+    def export_trace(self, file_name=None):
+        """ Returns the spans recorded so far in the Chrome Trace Event
+        format, and writes them to `file_name` as JSON if given. Combine the
+        traces of all peers with `merge_traces` to see one timeline. """
+        if self.tracer is None:
+            raise RuntimeError('Not tracing, call start_tracing first')
+        return self.tracer.export(file_name)
+    
+    
     def disconnect(self):
         """ End your games or similar sessions by calling this method. """
         self.session.disconnect()
@@ -509,27 +2205,1047 @@ class MultipeerConnectivity():
         Further communications will require instantiating a new
         MultipeerCommunications (sub)class. """
         self.stop_looking_for_peers()
+        self._stopped.set()
+        self._pacing_wakeup.set()
         self.disconnect()
+        self.stop_recording()
+        with _registry_lock:
+            peer_hashes = set(key[0] for key in self.outputstream_per_peer) | \
+                set(peer_id.hash() for peer_id in self._peer_ids.values())
+        for peer_hash in peer_hashes:
+            self._forget_peer(peer_hash)
+        self._peer_sessions.clear()
+        self._peer_keys.clear()
+        with _registry_lock:
+            self.peer_states.clear()
+            self.pending_invites.clear()
+            self.invite_queue.clear()
+            self._discovered_keys.clear()
+        self._handshaken_peers.clear()
+        self.initial_peer_data.clear()
+        self.session.setDelegate_(None)
+        self.browser.setDelegate_(None)
+        self.advertiser.setDelegate_(None)
+    
+        with _registry_lock:
+            for manager_object in (self.session, self.browser,
+                    self.advertiser):
+                mc_managers.pop(_pointer(manager_object), None)
+    
+    
+    def _invite(self, peer_id):
+        """ Invites the peer, or queues it if too many invitations are
+        already pending. """
+        peer_hash = peer_id.hash()
+        with _registry_lock:
+            # Free the slots of invitations that were never answered
+            expired = time.monotonic() - (self.invite_timeout or
+                _DEFAULT_INVITE_TIMEOUT)
+            for invited_hash in [invited_hash for invited_hash, invited_at
+                    in self.pending_invites.items() if invited_at < expired]:
+                del self.pending_invites[invited_hash]
+            if peer_hash in self.pending_invites:
+                return
+            if (self.max_concurrent_invites is not None and
+                    len(self.pending_invites) >= self.max_concurrent_invites):
+                if all(queued.hash() != peer_hash
+                        for queued in self.invite_queue):
+                    self.invite_queue.append(peer_id)
+                return
+            self.pending_invites[peer_hash] = time.monotonic()
+            self.peer_states.setdefault(peer_hash, PEER_INVITED)
+            peer_key = self._discovered_keys.pop(peer_hash, None)
+            if peer_key is not None:
+                self._peer_keys[peer_hash] = peer_key
+        context = self.initial_data
+        if self.resume_timeout is not None:
+            context = {_PEER_KEY: self.peer_key, 'initial_data': context}
+        context = json.dumps(context).encode() if context is not None else None
+        self.browser.invitePeer_toSession_withContext_timeout_(peer_id,
+            self.session, context, self.invite_timeout)
+    
+    
+    def _invite_finished(self, peer_id, connected):
+        """ Records the connection time and frees the invitation slot for
+        the next queued peer. """
+        with _registry_lock:
+            invited_at = self.pending_invites.pop(peer_id.hash(), None)
+            if invited_at is None:
+                return
+            next_peer = (self.invite_queue.popleft()
+                if len(self.invite_queue) > 0 else None)
+        if connected:
+            self.connect_times.append(time.monotonic() - invited_at)
+        if next_peer is not None:
+            self._invite(next_peer)
+    
+    
+    def _receive_stripe(self, channel, content, peer_id):
+        """ Collects segments sent with `send_bulk` from one of the stripe
+        streams, and delivers the payload once all its segments are in. """
+        peer_hash = peer_id.hash()
+        buffer = self._stripe_buffers.setdefault((peer_hash, channel),
+            bytearray())
+        buffer.extend(content)
+        while len(buffer) >= _stripe_header.size:
+            transfer_id, seq, count, length = _stripe_header.unpack_from(buffer)
+            end = _stripe_header.size + length
+            if len(buffer) < end:
+                break
+            transfer = self._incoming_bulk.setdefault((peer_hash, transfer_id),
+                { 'segments': {}, 'bytes': 0, 'started': time.monotonic() })
+            transfer['segments'][seq] = bytes(buffer[_stripe_header.size:end])
+            transfer['bytes'] += length
+            del buffer[:end]
+            if len(transfer['segments']) == count:
+                del self._incoming_bulk[(peer_hash, transfer_id)]
+                segments = transfer['segments']
+                self._send_control({
+                    'type': 'bulk_ack',
+                    'id': transfer_id,
+                    'bytes': transfer['bytes'],
+                    'seconds': time.monotonic() - transfer['started'],
+                }, [peer_id])
+                self.bulk_receive(b''.join(segments[i] for i in range(count)),
+                    peer_id)
+    
+    
+    def _receive_bulk_ack(self, message, peer_id):
+        """ Adjusts the number of stripes to the peer based on the
+        throughput the receiver measured: keeps adding stripes while that
+        gives the best throughput so far, otherwise uses the best count. """
+        peer_hash, stripes = self._bulk_transfers.pop(message['id'],
+            (None, None))
+        if peer_hash is None or message['bytes'] < 2*_STRIPE_SEGMENT_SIZE:
+            return
+        rate = message['bytes']/max(message['seconds'], 0.001)
+        rates = self._stripe_rates.setdefault(peer_hash, {})
+        rates[stripes] = (rates[stripes] + rate)/2 if stripes in rates else rate
+        best = max(rates, key=rates.get)
+        if best == max(rates) and best < MAX_STRIPES:
+            best += 1
+        self._stripe_counts[peer_hash] = best
+    
+    
+    def _announce_subscriptions(self, peers):
+        if len(peers) > 0:
+            self._send_control({
+                'type': 'subscriptions',
+                'topics': sorted(self.subscriptions),
+            }, peers)
+    
+    
+    def _receive_subscriptions(self, message, peer_id):
+        """ Replaces the subscriptions of the peer in the topic index. """
+        self._topic_index.replace(peer_id, set(message['topics']))
+    
+    
+    def _receive_publication(self, message, peer_id):
+        self.topic_receive(message['topic'], message['message'], peer_id)
+    
+    
+    def _receive_call(self, message, peer_id):
+        handler = self._call_handlers.get(message['name'], None)
+        response = { 'type': 'result', 'id': message['id'] }
+        if handler is None:
+            response['error'] = f'No handler registered for {message["name"]}'
+        else:
+            try:
+                response['result'] = handler(message['args'], peer_id)
+            except Exception as error:
+                response['error'] = f'{type(error).__name__}: {error}'
+        self._send_control(response, [peer_id])
+    
+    
+    def _receive_result(self, message, peer_id):
+        if 'error' in message:
+            self._finish_call(message['id'], None, RPCError(message['error']))
+        else:
+            self._finish_call(message['id'], message.get('result'))
+    
+    
+    def _finish_call(self, call_id, result=None, error=None):
+        """ Completes a pending call with a result or an error, whichever
+        comes first of result, timeout, cancellation or disconnect. """
+        with self._call_lock:
+            future, peer_hash, timer = self._pending_calls.pop(call_id,
+                (None, None, None))
+        if future is None:
+            return
+        if timer is not None:
+            timer.cancel()
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    
+    def _send_control(self, message, peers, reliable=True, sequenced=True):
+        """ Sends an internal message, a dict with a 'type' key, that is
+        handled by the `_control_handlers` of the receiver instead of
+        `receive`. """
+        data = _CONTROL_PREFIX + json.dumps(message).encode()
+        self._send_data(data, peers, reliable, sequenced)
+    
+    
+    def _send_data(self, data, peers, reliable=True, sequenced=True,
+            broadcast=False, msg_id=None):
+        """ Sends data to the peers. In resumable sessions, reliable data
+        is numbered and kept until the peers acknowledge it, and is only
+        queued for peers that are reconnecting, or for dropped peers if
+        `broadcast` is True. """
+        send_mode = 0 if reliable else 1
+        if self.resume_timeout is None or not reliable or not sequenced:
+            # Unsequenced data is internal and is not paced
+            self._transmit(data, peers, send_mode, paced=sequenced,
+                msg_id=msg_id)
+            return
+        untracked = []
+        futures = []
+        with self._resume_lock:
+            sessions = {}
+            for peer_id in peers:
+                session = self._session_for(peer_id)
+                if session is None:
+                    untracked.append(peer_id)
+                else:
+                    sessions[session.key] = session
+            if broadcast:
+                sessions.update((key, session) for key, session in
+                    self._peer_sessions.items() if session.dropped_at is not None)
+            if len(sessions) > 0:
+                self._send_seq += 1
+                frame = (_SEQUENCED_PREFIX +
+                    _sequence_header.pack(self._send_seq) + data)
+                live = []
+                for session in sessions.values():
+                    session.unacked.append((self._send_seq, frame))
+                    if not session.holding:
+                        live.append(session.peer_id)
+                if len(live) > 0:
+                    # Queued under the lock to keep the sequence order
+                    futures.append(self._transmit(frame, live, send_mode,
+                        drain=False, msg_id=msg_id))
+        if len(untracked) > 0:
+            futures.append(self._transmit(data, untracked, send_mode,
+                drain=False, msg_id=msg_id))
+        self._drain_outbox()
+        for future in futures:
+            self._wait(future)
+    
+    
+    def _transmit(self, data, peers, send_mode, paced=True, size=None,
+            drain=True, msg_id=None):
+        """ Submits data for the session and waits until it has been
+        handed over. With rate control, data for peers that have used up
+        their budget is queued for the pacing thread. With `drain` False,
+        the caller runs `_drain_outbox` and waits for the returned future
+        later, e.g. after releasing its locks. `msg_id` is given for traced
+        messages. """
+        queued_at = None if msg_id is None else time.time()
+        if self.rate_control and paced:
+            size = len(data) if size is None else size
+            now = time.monotonic()
+            direct = []
+            with self._rate_lock:
+                for peer_id in peers:
+                    controller = self._rate_controllers.get(peer_id.hash(),
+                        None)
+                    if controller is None or controller.take(size, now):
+                        direct.append(peer_id)
+                    else:
+                        controller.queue.append((data, size, send_mode,
+                            msg_id, queued_at))
+                        controller.queued_bytes += size
+                        self._pacing_wakeup.set()
+            peers = direct
+            if len(peers) == 0:
+                return None
+        future = concurrent.futures.Future()
+        self._outbox.append((self._send_now,
+            (data, peers, send_mode, msg_id, queued_at), future))
+        if drain:
+            self._drain_outbox()
+            self._wait(future)
+        return future
+    
+    
+    def _send_now(self, data, peers, send_mode, msg_id=None, queued_at=None):
+        """ Writer job that hands data to the session. """
+        tracer = self.tracer if msg_id is not None else None
+        if tracer is not None:
+            started = time.time()
+            tracer.span('queue', queued_at, msg_id, end=started)
+        sent = self.session.sendData_toPeers_withMode_error_(data, peers,
+            send_mode, None)
+        if tracer is not None:
+            tracer.span('bridge', started, msg_id)
+        if not sent and self.rate_control:
+            for peer_id in peers:
+                self._congestion(peer_id.hash())
+    
+    
+    def _submit(self, job, *args):
+        """ Runs `job(*args)` as the only writer to the session and the
+        output streams, and returns its result. Jobs submitted from any
+        thread run one at a time in the order they were submitted. """
+        future = concurrent.futures.Future()
+        self._outbox.append((job, args, future))
+        self._drain_outbox()
+        return self._wait(future)
+    
+    
+    def _wait(self, future):
+        """ Returns the result of a submitted job, or raises its
+        exception. A job submitted by a running job, e.g. from a callback,
+        only runs after it, so its result is not waited for and its errors
+        are printed. A None `future` is ignored. """
+        if future is None:
+            return None
+        if self._writer == threading.get_ident():
+            future.add_done_callback(_print_job_error)
+            return None
+        return future.result()
+    
+    
+    def _drain_outbox(self):
+        """ Runs the submitted jobs, unless another thread is already
+        doing it. The thread that finds no writer active becomes the
+        writer, so an uncontended send runs right away on the calling
+        thread, and a busy writer also runs the jobs that other threads
+        submit meanwhile. """
+        outbox = self._outbox
+        # Checked again after releasing the lock, in case a job was
+        # submitted by a thread that found the lock still taken
+        while len(outbox) > 0 and self._writer_lock.acquire(blocking=False):
+            self._writer = threading.get_ident()
+            try:
+                while len(outbox) > 0:
+                    job, args, future = outbox.popleft()
+                    try:
+                        result = job(*args)
+                    except Exception as error:
+                        # Raised to the thread that submitted the job
+                        if future is None:
+                            traceback.print_exc()
+                        else:
+                            future.set_exception(error)
+                    else:
+                        if future is not None:
+                            future.set_result(result)
+            finally:
+                self._writer = None
+                self._writer_lock.release()
+        if len(self._rate_reports) > 0:
+            self._report_rates()
+    
+    
+    def _report_rates(self):
+        """ Calls `rate_changed` for the rate changes found by writer jobs.
+        Called with the writer lock released, as the callback may wait for
+        the main thread, which may be waiting to write. """
+        while True:
+            with self._rate_lock:
+                if len(self._rate_reports) == 0:
+                    return
+                peer_id, rate = self._rate_reports.popleft()
+            self.rate_changed(peer_id, rate)
+    
+    
+    def _congestion(self, peer_hash):
+        """ Lowers the rate of a peer that is not keeping up. Called by
+        writer jobs, so the change is reported by `_drain_outbox`. """
+        with self._rate_lock:
+            controller = self._rate_controllers.get(peer_hash, None)
+            if controller is None:
+                return
+            controller.decrease(time.monotonic())
+            rate = controller.report()
+            if rate is not None:
+                self._rate_reports.append((controller.peer_id, rate))
+    
+    
+    def _pacing_loop(self):
+        """ Sends queued data as the budget of each peer allows, flushes
+        paced streams and measures round-trip times, until `end_all` is
+        called. """
+        next_probe = 0
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            if now >= next_probe:
+                next_probe = now + _RATE_PROBE_INTERVAL
+                with self._rate_lock:
+                    peers = [controller.peer_id for controller in
+                        self._rate_controllers.values()]
+                if len(peers) > 0:
+                    self._send_control({'type': 'ping', 't': now}, peers,
+                        reliable=False, sequenced=False)
+            with self._rate_lock:
+                for controller in self._rate_controllers.values():
+                    queue = controller.queue
+                    while len(queue) > 0 and controller.allowance(now) > 0:
+                        data, size, send_mode, msg_id, queued_at = \
+                            queue.popleft()
+                        controller.queued_bytes -= size
+                        controller.tokens -= size
+                        # Queued under the lock to keep the order
+                        self._outbox.append((self._send_now, (data,
+                            [controller.peer_id], send_mode, msg_id,
+                            queued_at), None))
+                streams = list(self._paced_streams)
+                self._paced_streams.clear()
+                waiting = any(len(controller.queue) > 0
+                    for controller in self._rate_controllers.values())
+            for key in streams:
+                self._outbox.append((self._flush_stream, (key,), None))
+            self._drain_outbox()
+            waiting = waiting or len(self._paced_streams) > 0
+            self._pacing_wakeup.wait(_PACING_INTERVAL if waiting else
+                max(0, next_probe - time.monotonic()))
+            self._pacing_wakeup.clear()
+    
+    
+    def _receive_ping(self, message, peer_id):
+        self._send_control({'type': 'pong', 't': message['t']}, [peer_id],
+            reliable=False, sequenced=False)
+    
     
-        del mc_managers[self.my_id.hash()]
+    def _receive_pong(self, message, peer_id):
+        now = time.monotonic()
+        with self._rate_lock:
+            controller = self._rate_controllers.get(peer_id.hash(), None)
+            if controller is None:
+                return
+            controller.round_trip(now - message['t'], now)
+            rate = controller.report()
+        if rate is not None:
+            self.rate_changed(peer_id, rate)
     
     
-    def _peer_collector(self, peer_id):
-        """ Makes sure that `peer_added` is only called after the full "two-way
-        handshake" is complete and the initial context info has been captured.
+    def _receive_sequenced(self, data, peer_id):
+        """ Returns the data without the sequence number, or None if it
+        was already received before a reconnection. """
+        seq, = _sequence_header.unpack_from(data, 1)
+        acknowledge = False
+        with self._resume_lock:
+            session = self._session_for(peer_id)
+            if session is not None:
+                if seq <= session.received:
+                    return None
+                session.received = seq
+                session.since_ack += 1
+                if session.since_ack >= _ACK_INTERVAL:
+                    session.since_ack = 0
+                    acknowledge = True
+        if acknowledge:
+            self._send_control({'type': 'ack', 'seq': seq}, [peer_id],
+                reliable=False, sequenced=False)
+        return data[1 + _sequence_header.size:]
+    
+    
+    def _receive_ack(self, message, peer_id):
+        with self._resume_lock:
+            session = self._session_for(peer_id)
+            if session is not None:
+                session.acknowledged(message['seq'])
+    
+    
+    def _receive_resume(self, message, peer_id):
+        """ The peer has connected and tells what it has received from us.
+        Sends again what it has not received, and stops holding data. """
+        if self._session_for(peer_id) is None:
+            # Arrived before the connection was reported
+            self._start_session(peer_id)
+        with self._resume_lock:
+            session = self._session_for(peer_id)
+            if session is None:
+                return
+            if message['resumed'] and session.resumed:
+                session.acknowledged(message['received'])
+            else:
+                # One side started over, so only data sent since connecting
+                # is relevant
+                session.acknowledged(session.resume_seq)
+            session.holding = False
+            futures = [self._transmit(frame, [peer_id], 0, drain=False)
+                for seq, frame in session.unacked]
+        self._drain_outbox()
+        for future in futures:
+            self._wait(future)
+    
+    
+    def _session_for(self, peer_id):
+        return self._peer_sessions.get(
+            self._peer_keys.get(peer_id.hash(), None), None)
+    
+    
+    def _start_session(self, peer_id):
+        """ Creates the session for a newly connected peer with a known
+        key, or resumes the session of a dropped peer, and tells the peer
+        what we have received from it. """
+        peer_hash = peer_id.hash()
+        key = self._peer_keys.get(peer_hash, None)
+        if key is None:
+            return
+        with self._resume_lock:
+            session = self._peer_sessions.get(key, None)
+            if (session is not None and session.dropped_at is None and
+                    session.peer_id.hash() == peer_hash):
+                # Already started by an early resume message
+                return
+            resumed = session is not None and session.dropped_at is not None
+            if resumed:
+                old_hash = session.peer_id.hash()
+                session.peer_id = peer_id
+                session.dropped_at = None
+            else:
+                session = self._peer_sessions[key] = _PeerSession(key, peer_id)
+            session.holding = True
+            session.resumed = resumed
+            session.resume_seq = self._send_seq
+            session.inviter = peer_hash in self.pending_invites
+            received = session.received
+        if resumed and old_hash != peer_hash:
+            self._rekey_peer(old_hash, peer_hash)
+        self._send_control({
+            'type': 'resume',
+            'received': received,
+            'resumed': resumed,
+        }, [peer_id], sequenced=False)
+    
+    
+    def _rekey_peer(self, old_hash, new_hash):
+        """ Moves what is known about a resumed peer that reconnected with
+        a different peer ID. Subscriptions are announced again. """
+        with _registry_lock:
+            self.peer_states.pop(old_hash, None)
+        self._peer_keys.pop(old_hash, None)
+        if old_hash in self.initial_peer_data:
+            self.initial_peer_data[new_hash] = self.initial_peer_data.pop(
+                old_hash)
+        self._topic_index.remove(old_hash)
+        with self._call_lock:
+            for call_id, (future, peer_hash, timer) in list(
+                    self._pending_calls.items()):
+                if peer_hash == old_hash:
+                    self._pending_calls[call_id] = (future, new_hash, timer)
+    
+    
+    def _peer_dropped(self, peer_id, session):
+        """ Keeps the session of a lost peer for `resume_timeout` seconds
+        and tries to reconnect, instead of removing the peer. """
+        peer_hash = peer_id.hash()
+        with _registry_lock:
+            self.peer_states[peer_hash] = PEER_DROPPED
+        with self._resume_lock:
+            dropped_at = None
+            if session.dropped_at is None:
+                dropped_at = session.dropped_at = time.monotonic()
+                session.holding = True
+        if dropped_at is not None:
+            # Runs before the streams are closed
+            self._submit(self._save_streams, peer_hash, session)
+        self._forget_connection(peer_hash)
+        if dropped_at is None:
+            # Failed reconnection attempt, already waiting
+            return
+        timer = threading.Timer(self.resume_timeout, self._resume_expired,
+            (session, dropped_at))
+        timer.daemon = True
+        timer.start()
+        if self.invite_mode == 'mutual' or session.inviter:
+            self._reinvite(session, dropped_at, _REINVITE_DELAY)
+    
+    
+    def _reinvite(self, session, dropped_at, delay):
+        def reinvite_due():
+            if session.dropped_at != dropped_at or self._stopped.is_set():
+                return
+            self._invite(session.peer_id)
+            self._reinvite(session, dropped_at,
+                min(delay*2, _MAX_REINVITE_DELAY))
+        timer = threading.Timer(delay, reinvite_due)
+        timer.daemon = True
+        timer.start()
+    
+    
+    def _resume_expired(self, session, dropped_at):
+        """ Removes a dropped peer that did not reconnect in time. """
+        with self._resume_lock:
+            if (session.dropped_at != dropped_at or
+                    self._peer_sessions.get(session.key, None) is not session):
+                return
+            del self._peer_sessions[session.key]
+        peer_id = session.peer_id
+        peer_hash = peer_id.hash()
+        with _registry_lock:
+            if self.peer_states.get(peer_hash, None) == PEER_DROPPED:
+                del self.peer_states[peer_hash]
+        if self.recorder is not None:
+            self.recorder.write(RECORD_PEER_REMOVED, peer_id)
+        self.peer_removed(peer_id)
+        self._forget_peer(peer_hash)
+    
+    
+    def _receive_traced(self, data, peer_id, msg_id):
+        """ Passes on a traced message like the delegate function does,
+        recording the decoding and the handler as spans. """
+        tracer = self.tracer
+        if data[:1] == _BUFFER_PREFIX:
+            record_type = RECORD_BUFFER_RECEIVE
+            decode, handler = _decode_buffer, self.buffer_receive
+        elif data[:1] == _MESSAGE_PREFIX:
+            record_type = RECORD_MESSAGE_RECEIVE
+            type_id, = _message_header.unpack_from(data, 1)
+            decode, handler = self._message_handlers.get(type_id, (
+                decode_message, self.message_receive))
+        else:
+            record_type = RECORD_RECEIVE
+            decode, handler = (lambda data: json.loads(data.decode()),
+                self.receive)
+        if self.recorder is not None:
+            self.recorder.write(record_type, peer_id, data)
+        message = tracer.call('decode', msg_id, decode, data)
+        if message is not None or record_type == RECORD_RECEIVE:
+            tracer.call('handler', msg_id, handler, message, peer_id)
+    
+    
+    def _dispatch_message(self, data, peer_id):
+        type_id, = _message_header.unpack_from(data, 1)
+        handler = self._message_handlers.get(type_id, None)
+        if handler is not None:
+            decode, handler = handler
+            handler(decode(data), peer_id)
+            return
+        message = decode_message(data)
+        if message is not None:
+            self.message_receive(message, peer_id)
+    
+    
+    def _receive_schema(self, message, peer_id):
+        type_ids = {message_type.__name__: type_id
+            for type_id, message_type in message_types.items()}
+        names = sorted(name for name, type_id in message['types'].items()
+            if type_ids.get(name, type_id) != type_id)
+        if len(names) > 0:
+            self.schema_mismatch(peer_id, names)
+    
+    
+    def _receive_control(self, message, peer_id):
+        handler = self._control_handlers.get(message.get('type'), None)
+        if handler is not None:
+            handler(message, peer_id)
+    
+    
+    def _receive_heartbeat(self, message, peer_id):
+        peer_hash = peer_id.hash()
+        with self._heartbeat_lock:
+            heartbeat = self._heartbeats.get(peer_hash, None)
+            if heartbeat is None:
+                return
+            # Silences while suspected would distort the learned intervals
+            suspected = peer_hash in self._suspected_peers
+            heartbeat[1].heartbeat(learn=not suspected)
+            self._suspected_peers.discard(peer_hash)
+        if suspected:
+            self.peer_recovered(peer_id)
+    
+    
+    def _heartbeat_loop(self):
+        """ Sends heartbeats to added peers and reports the peers whose
+        heartbeats have stopped, until `end_all` is called. """
+        while not self._stopped.wait(self.heartbeat_interval):
+            with self._heartbeat_lock:
+                heartbeats = list(self._heartbeats.items())
+            if len(heartbeats) == 0:
+                continue
+            # Not paced, so that heartbeats are not held up behind data
+            self._send_control({'type': 'hb'},
+                [peer_id for _, (peer_id, _) in heartbeats], reliable=False,
+                sequenced=False)
+            for peer_hash, (peer_id, detector) in heartbeats:
+                if detector.phi() < self.phi_threshold:
+                    continue
+                with self._heartbeat_lock:
+                    if (peer_hash in self._suspected_peers or
+                            peer_hash not in self._heartbeats):
+                        continue
+                    self._suspected_peers.add(peer_hash)
+                self.peer_suspected(peer_id)
+    
+    
+    def _receive_hello(self, message, peer_id):
+        """ Initial data from a peer that we invited in the 'single' invite
+        mode. """
+        if message.get('initial_data') is not None:
+            self.initial_peer_data[peer_id.hash()] = message['initial_data']
+        self._handshake_complete(peer_id)
+    
+    
+    def _handshake_complete(self, peer_id):
+        """ Called when the initial data of the peer has been captured,
+        from an invitation or a hello message. """
+        peer_hash = peer_id.hash()
+        self._handshaken_peers.add(peer_hash)
+        with _registry_lock:
+            self.peer_states.setdefault(peer_hash, PEER_INVITED)
+        self._check_peer_ready(peer_id)
+    
+    
+    def _peer_connected(self, peer_id):
+        peer_hash = peer_id.hash()
+        with _registry_lock:
+            if self.peer_states.get(peer_hash, None) == PEER_ADDED:
+                return
+            self.peer_states[peer_hash] = PEER_CONNECTED
+        if self.resume_timeout is not None:
+            self._start_session(peer_id)
+        if self.invite_mode == 'single':
+            # Inviting peer did not get our initial data with an invitation
+            self._send_control({
+                'type': 'hello',
+                'initial_data': self.initial_data,
+            }, [peer_id], sequenced=False)
+        self._check_peer_ready(peer_id)
+    
+    
+    def _check_peer_ready(self, peer_id):
+        """ Makes sure that `peer_added` is only called once, after the
+        session is connected and the initial context info has been captured.
         Also sets up a stream to peer if requested by the constructor argument. """
         peer_hash = peer_id.hash()
-        self._peer_connection_hit_count.setdefault(peer_hash, 0)
-        self._peer_connection_hit_count[peer_hash] += 1
-        if self._peer_connection_hit_count[peer_hash] > 1:
-            if (self.initialize_streams and peer_hash not in
-                    self.outputstream_per_peer):
-                self._set_up_stream(peer_id)
-            self.peer_added(peer_id)
+        with _registry_lock:
+            if (self.peer_states.get(peer_hash, None) != PEER_CONNECTED or
+                    peer_hash not in self._handshaken_peers):
+                return
+            self.peer_states[peer_hash] = PEER_ADDED
+        session = self._session_for(peer_id)
+        resumed = session is not None and session.resumed
+        if resumed:
+            self._submit(self._restore_streams, peer_id, session)
+        if self.initialize_streams:
+            self._submit(self._write_stream, peer_id, DEFAULT_STREAM, b'')
+        if len(self.subscriptions) > 0:
+            self._announce_subscriptions([peer_id])
+        if len(message_types) > 0:
+            self._send_control({
+                'type': 'schema',
+                'types': {message_type.__name__: type_id
+                    for type_id, message_type in message_types.items()},
+            }, [peer_id])
+        if self.heartbeat_interval is not None:
+            with self._heartbeat_lock:
+                self._heartbeats[peer_hash] = (peer_id,
+                    _PhiAccrualDetector(self.heartbeat_interval))
+        if self.rate_control:
+            with self._rate_lock:
+                self._rate_controllers[peer_hash] = _RateController(peer_id)
+        if resumed:
+            self.peer_resumed(peer_id)
+            return
+        if session is not None:
+            session.added = True
+        if self.recorder is not None:
+            initial_data = self.get_initial_data(peer_id)
+            self.recorder.write(RECORD_PEER_ADDED, peer_id,
+                b'' if initial_data is None else
+                json.dumps(initial_data).encode())
+        self.peer_added(peer_id)
+    
+    
+    def _peer_disconnected(self, peer_id):
+        peer_hash = peer_id.hash()
+        with _registry_lock:
+            state = self.peer_states.pop(peer_hash, None)
+        self._handshaken_peers.discard(peer_hash)
+        session = self._session_for(peer_id)
+        if session is not None and session.added:
+            self._peer_dropped(peer_id, session)
+            return
+        if state == PEER_ADDED:
+            if self.recorder is not None:
+                self.recorder.write(RECORD_PEER_REMOVED, peer_id)
+            self.peer_removed(peer_id)
+        self._forget_peer(peer_hash)
+    
+    
+    def _forget_peer(self, peer_hash):
+        """ Closes the streams of a peer that has left and drops all
+        bookkeeping about it, so that memory use does not grow with the
+        number of peers seen. """
+        self.initial_peer_data.pop(peer_hash, None)
+        self._topic_index.remove(peer_hash)
+        with self._call_lock:
+            call_ids = [call_id for call_id, pending in
+                self._pending_calls.items() if pending[1] == peer_hash]
+        for call_id in call_ids:
+            self._finish_call(call_id, None,
+                ConnectionError('Peer disconnected'))
+        key = self._peer_keys.pop(peer_hash, None)
+        if key is not None:
+            with self._resume_lock:
+                session = self._peer_sessions.get(key, None)
+                if session is not None and session.peer_id.hash() == peer_hash:
+                    del self._peer_sessions[key]
+        self._forget_connection(peer_hash)
+    
+    
+    def _forget_connection(self, peer_hash):
+        """ Closes the streams of a disconnected peer and drops the state
+        of the connection, but keeps what a resumed session needs. """
+        with _registry_lock:
+            self.pending_invites.pop(peer_hash, None)
+            self.invite_queue = deque(peer_id for peer_id in self.invite_queue
+                if peer_id.hash() != peer_hash)
+        with self._heartbeat_lock:
+            self._heartbeats.pop(peer_hash, None)
+            self._suspected_peers.discard(peer_hash)
+        with self._rate_lock:
+            self._rate_controllers.pop(peer_hash, None)
+            self._paced_streams = set(key for key in self._paced_streams
+                if key[0] != peer_hash)
+        self._stripe_counts.pop(peer_hash, None)
+        self._stripe_rates.pop(peer_hash, None)
+        for transfers in (self._stripe_buffers, self._incoming_bulk):
+            for key in [key for key in transfers if key[0] == peer_hash]:
+                del transfers[key]
+        self._bulk_transfers = { transfer_id: transfer for transfer_id, transfer
+            in self._bulk_transfers.items() if transfer[0] != peer_hash }
+        self._submit(self._close_streams, peer_hash)
+        with _registry_lock:
+            for pointer in [pointer for pointer in self.inputstreams
+                    if mc_inputstream_managers[pointer][1].hash() ==
+                    peer_hash]:
+                self._forget_inputstream(pointer)
+            for pointer in [pointer for pointer, peer_id in
+                    self._peer_ids.items() if peer_id.hash() == peer_hash]:
+                del self._peer_ids[pointer]
+    
+    
+    def _forget_inputstream(self, pointer):
+        with _registry_lock:
+            mc_inputstream_managers.pop(pointer, None)
+            stream = self.inputstreams.pop(pointer, None)
+        if stream is not None:
+            _close_stream(stream)
+    
+    
+    def _get_peer(self, peer_pointer, cache=True):
+        """ Returns the peer ID for a raw pointer received by a delegate
+        function, with the `display_name` member set. With `cache`, IDs are
+        cached until the peer disconnects. """
+        peer_id = self._peer_ids.get(peer_pointer, None)
+        if peer_id is None:
+            peer_id = ObjCInstance(peer_pointer)
+            peer_id.display_name = str(peer_id.displayName())
+            if cache:
+                with _registry_lock:
+                    self._peer_ids[peer_pointer] = peer_id
+        return peer_id
+
+
+class _LatencyProbe(MultipeerConnectivity):
+    """ Peer used by `probe_latency`. """
+
+    def __init__(self, **kwargs):
+        self.connected = threading.Event()
+        self.peer_done = threading.Event()
+        super().__init__(**kwargs)
+        self.register('echo', lambda args, from_peer: args)
+        self.register('done', lambda args, from_peer: self.peer_done.set())
+
+    def peer_added(self, peer_id):
+        self.peer = peer_id
+        self.connected.set()
+
+    def peer_removed(self, peer_id):
+        self.peer_done.set()
+
+
+def probe_latency(encryptions=('required', 'optional', 'none'), count=100,
+        payload_size=32, service_type='mc-probe', wait=30):
+    """ Measures message round-trip times to another device running this
+    function at the same time, once with each encryption setting, and prints
+    a summary per setting. Returns a dict of lists of round-trip times in
+    seconds, keyed by the encryption setting.
+
+    * `encryptions` - settings to measure, see the constructor of
+    `MultipeerConnectivity`.
+    * `count` - number of round trips per setting.
+    * `payload_size` - size of the message payload in characters.
+    * `service_type` - service type used for the probe sessions.
+    * `wait` - seconds to wait for the other device.
+    """
+    import platform, statistics
+
+    results = {}
+    for encryption in encryptions:
+        probe = _LatencyProbe(display_name=platform.node()[:60] or 'Probe',
+            service_type=service_type, encryption=encryption)
+        try:
+            if not probe.connected.wait(wait):
+                print(f'{encryption}: no peer found')
+                continue
+            payload = 'x' * payload_size
+            times = []
+            for _ in range(count):
+                start = time.perf_counter()
+                probe.call(probe.peer, 'echo', payload, timeout=wait).result()
+                times.append(time.perf_counter() - start)
+            probe.call(probe.peer, 'done')
+            probe.peer_done.wait(wait)
+        finally:
+            probe.end_all()
+        results[encryption] = times
+        print(f'{encryption}: mean {statistics.mean(times)*1000:.2f} ms, '
+            f'median {statistics.median(times)*1000:.2f} ms, '
+            f'min {min(times)*1000:.2f} ms per round trip')
+    return results
+
+
+def benchmark_buffers(sizes=(1024, 16384, 131072, 1048576), repeats=20):
+    """ Compares the cost of sending a float array as JSON with `send`
+    and as a buffer with `send_buffer`, by timing the encoding to NSData
+    and the decoding back to an array on this device, for arrays of the
+    given sizes in bytes. Prints the message sizes and milliseconds per
+    message, and returns them as a list of (size, JSON bytes, JSON time,
+    buffer bytes, buffer time) tuples. Needs NumPy. """
+    results = []
+    for size in sizes:
+        array = numpy.random.random(size//8)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            message = json.dumps(array.tolist()).encode()
+            data = ns(message)
+            numpy.array(json.loads(nsdata_to_bytes(data).decode()))
+        json_time = (time.perf_counter() - start)/repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            view = memoryview(array)
+            data = _buffer_nsdata(_buffer_header(view), view)
+            _decode_buffer(nsdata_to_bytes(data))
+        buffer_time = (time.perf_counter() - start)/repeats
+        results.append((size, len(message), json_time, data.length(),
+            buffer_time))
+        print(f'{size} bytes: JSON {len(message)} bytes '
+            f'{json_time*1000:.2f} ms, buffer {data.length()} bytes '
+            f'{buffer_time*1000:.2f} ms')
+    return results
+
+
+def benchmark_dispatch(events=100000):
+    """ Compares two ways for the delegate functions to get from the raw
+    pointers they receive to the Python objects they need: wrapping the
+    pointer in an `ObjCInstance` on every callback, and looking the pointer
+    up in the registries.
+
+    * `manager` - the manager of the session, browser or advertiser, found
+    by `get_self` on every callback. Wrapped, it is found by the hash of the
+    peer ID of the session; by pointer, in `mc_managers`.
+    * `stream` - the manager, peer, channel and stream object of a stream
+    event. By pointer, the instance kept in `mc_inputstream_managers` is
+    reused.
+
+    Times `events` lookups of each and prints and returns the microseconds
+    per callback as a dict of (wrapped, by pointer) tuples. """
+    results = {}
+    peer_id = MCPeerID.alloc().initWithDisplayName('Benchmark')
+    session = MCSession.alloc().initWithPeer_(peer_id)
+    pointer = _pointer(session)
+    by_hash = {peer_id.hash(): None}
+    by_pointer = {pointer: None}
+    start = time.perf_counter()
+    for _ in range(events):
+        manager = by_hash.get(ObjCInstance(pointer).myPeerID().hash(), None)
+    wrapped_time = (time.perf_counter() - start)/events
+    start = time.perf_counter()
+    for _ in range(events):
+        manager = by_pointer.get(_pointer(pointer), None)
+    pointer_time = (time.perf_counter() - start)/events
+    results['manager'] = (wrapped_time*1e6, pointer_time*1e6)
+
+    # Any ObjC object will do as the stream, only the lookup is timed
+    stream = NSMutableData.alloc().init()
+    pointer = _pointer(stream)
+    registry = {pointer: (None, None, DEFAULT_STREAM, stream)}
+    start = time.perf_counter()
+    for _ in range(events):
+        manager, peer_id, channel, _ = registry.get(pointer,
+            (None, None, None, None))
+        event_stream = ObjCInstance(pointer)
+    wrapped_time = (time.perf_counter() - start)/events
+    start = time.perf_counter()
+    for _ in range(events):
+        manager, peer_id, channel, event_stream = registry.get(pointer,
+            (None, None, None, None))
+    kept_time = (time.perf_counter() - start)/events
+    results['stream'] = (wrapped_time*1e6, kept_time*1e6)
+    for name, (wrapped, by_pointer) in results.items():
+        print(f'{name}: wrapped {wrapped:.2f} us, '
+            f'by pointer {by_pointer:.2f} us per callback')
+    return results
+
+
+def benchmark_fanout(topic_counts=(10, 100, 1000, 10000), peer_count=8,
+        patterns=2, publishes=10000):
+    """ Times how long `publish` takes to find the subscribers of a
+    topic as the number of topics grows. Each of `peer_count` peers
+    subscribes to an equal share of the topics and to `patterns` wildcard
+    patterns. Topics are published in turn, once with the subscribers
+    looked up every time, as for topics that are seldom published, and
+    once from the cache. Prints the microseconds per publish and returns
+    them as a list of (topic count, lookup, cached) tuples. """
+    results = []
+    for topic_count in topic_counts:
+        index = _TopicIndex()
+        topics = [f'sensors/{i}/value' for i in range(topic_count)]
+        for i in range(peer_count):
+            index.replace(_ReplayPeer(i, f'Peer {i}'),
+                set(topics[i::peer_count]) |
+                set(f'sensors/+/alarm{i*patterns + j}' for j in range(patterns)))
+        published = [topics[i % topic_count] for i in range(publishes)]
+        start = time.perf_counter()
+        for topic in published:
+            with index.lock:
+                index._match(topic)
+        lookup_time = (time.perf_counter() - start)/publishes
+        warm = published[:min(index.cache_size, topic_count)]
+        for topic in warm:
+            index.subscribers(topic)
+        cached = warm*(publishes//len(warm))
+        start = time.perf_counter()
+        for topic in cached:
+            index.subscribers(topic)
+        cached_time = (time.perf_counter() - start)/len(cached)
+        results.append((topic_count, lookup_time*1e6, cached_time*1e6))
+        print(f'{topic_count} topics: lookup {lookup_time*1e6:.2f} us, '
+            f'cached {cached_time*1e6:.2f} us per publish')
+    return results
 
 
 if __name__ == '__main__':
 
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'buffers':
+        benchmark_buffers()
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'dispatch':
+        benchmark_dispatch()
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'fanout':
+        benchmark_fanout()
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'probe':
+        # Run on two devices to compare the encryption settings
+        probe_latency()
+        sys.exit()
+
     # Simple chat peer to demonstrate basic functionality
 
     import platform
@@ -1,17 +1,127 @@
 #coding: utf-8
 
+import json, zlib
+from collections import deque
+
+import ui
+from objc_util import on_main_thread
+import multipeer
+
+
+class ChatHistory(multipeer.MultipeerConnectivity):
+  '''
+  Chat peer that keeps the latest `max_messages` messages and shows them in the `text_view`, a `ui.TextView`. The view is updated at most once per frame, however fast messages arrive, and is only rebuilt when old messages have to be dropped.
+  
+  Peers that join later get the history from the first peer they see, as a single zlib-compressed buffer unless `compress_backlog` is False. It goes ahead of the messages that arrived while waiting for it, and messages already in the history are skipped, so the history does not get duplicated.
+  
+  Chat messages are dicts with the `text` and a running `count` per sender.
+  '''
+  
+  def __init__(self, text_view=None, max_messages=500, compress_backlog=True, **kwargs):
+    self.text_view = text_view
+    self.history = deque(maxlen=max_messages)
+    self.seen = set()
+    self.pending = []
+    self.rebuild = False
+    self.flush_scheduled = False
+    self.compress_backlog = compress_backlog
+    self.backlog_requested = False
+    self.backlog_peer = None
+    super().__init__(**kwargs)
+    self.register('backlog', self.backlog)
+    
+  def format_message(self, name, text, count):
+    return name + ': ' + text + ' (#' + str(count) + ')\n'
+    
+  def add_message(self, name, text, count):
+    ''' Adds a message to the history and schedules a view update. Returns False for messages already in the history. Call on the main thread. '''
+    entry = (name, text, count)
+    if entry in self.seen:
+      return False
+    if len(self.history) == self.history.maxlen:
+      self.seen.discard(self.history[0])
+      self.rebuild = True
+    self.history.append(entry)
+    self.seen.add(entry)
+    self.pending.append(self.format_message(*entry))
+    self.schedule_flush()
+    return True
+    
+  def add_backlog(self, entries):
+    ''' Puts messages from before this peer joined ahead of the history, skipping the ones already in it, and rebuilds the view once. The oldest messages are dropped if there are too many. Call on the main thread. '''
+    older = [entry for entry in dict.fromkeys(tuple(entry) for entry in entries) if entry not in self.seen]
+    if len(older) == 0:
+      return
+    self.history = deque(older + list(self.history), maxlen=self.history.maxlen)
+    self.seen = set(self.history)
+    self.rebuild = True
+    self.schedule_flush()
+    
+  def schedule_flush(self):
+    if not self.flush_scheduled:
+      self.flush_scheduled = True
+      ui.delay(self.flush, 1/60)
+    
+  def flush(self):
+    self.flush_scheduled = False
+    if self.text_view is not None:
+      if self.rebuild:
+        self.text_view.text = ''.join(self.format_message(*entry) for entry in self.history)
+      else:
+        self.text_view.text += ''.join(self.pending)
+    self.rebuild = False
+    self.pending.clear()
+    
+  @on_main_thread
+  def peer_added(self, peer_id):
+    if not self.backlog_requested:
+      self.backlog_requested = True
+      self.backlog_peer = peer_id.hash()
+      self.call(peer_id, 'backlog', timeout=10).add_done_callback(self.backlog_received)
+      
+  @on_main_thread
+  def receive(self, message, from_peer):
+    self.add_message(from_peer.display_name, message['text'], message['count'])
+    
+  @on_main_thread
+  def history_entries(self):
+    ''' Returns a copy of the history, taken on the main thread, which changes it. '''
+    return list(self.history)
+    
+  def backlog(self, args, from_peer):
+    entries = self.history_entries()
+    if not self.compress_backlog:
+      return entries
+    # Sent as raw bytes, the result only confirms it
+    self.send_buffer(zlib.compress(json.dumps(entries).encode()), from_peer)
+    return None
+    
+  @on_main_thread
+  def backlog_received(self, future):
+    if future.cancelled() or future.exception() is not None:
+      return
+    entries = future.result()
+    if entries is not None:
+      self.backlog_peer = None
+      self.add_backlog(entries)
+      
+  @on_main_thread
+  def buffer_receive(self, buffer, from_peer):
+    # Compressed backlog
+    if from_peer.hash() == self.backlog_peer:
+      self.backlog_peer = None
+      self.add_backlog(json.loads(zlib.decompress(buffer)))
+
+
 if __name__ == '__main__':
 
   # Peer chat UI as a demonstration
 
-  import ui
-  import multipeer
-  from objc_util import *
-  
-  class ChatPeer(multipeer.MultipeerConnectivity):
+  class ChatPeer(ChatHistory):
     
     @on_main_thread
     def peer_added(self, peer):
+      super().peer_added(peer)
       self.show_updated_peer_list()
       
     @on_main_thread
@@ -22,11 +132,6 @@ if __name__ == '__main__':
       peer_list = self.get_peers()
       as_text = 'Chatting with:\n' +  '\n'.join([peer.display_name for peer in peer_list])
       peers.text = as_text
-      
-    @on_main_thread
-    def receive(self, message, from_peer):
-      msg = from_peer.display_name + ': ' + message['text'] + ' (#' + str(message['count']) + ')\n'
-      received_messages.text += msg
   
   class ChatView(ui.View):
     
@@ -48,7 +153,7 @@ if __name__ == '__main__':
         send_button.touch_enabled = True
         peers.text = 'Looking for peers'
         
-        self.mc = ChatPeer(service_type='chat-demo', display_name=chat_name)
+        self.mc = ChatPeer(text_view=received_messages, service_type='chat-demo', display_name=chat_name)
         
     def send_message(self, sender):
       self.message_count += 1
@@ -0,0 +1,915 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load generator for the multipeer module
+
+Starts a number of `MultipeerConnectivity` peers in this process, connected
+through a loopback stand-in for the MC framework session, browser and
+advertiser, runs a mix of scripted traffic between them and prints the
+throughput, latency percentiles and memory use. All of the Python side of
+the multipeer module runs as it would on devices, including the delegate
+functions, invitations, NSData and NSStreams, so the results are repeatable
+and can be compared between versions to catch performance regressions
+before trying them on devices.
+
+Run in Pythonista with arguments, for example:
+
+    multipeer_loadgen.py --peers 6 --mix chat,ticks,bulk,churn --duration 20
+
+Traffic mixes:
+
+* `chat` - every peer sends small JSON messages to all peers.
+* `ticks` - every peer streams small packets to every other peer at a
+fixed tick rate, like the `lightcycle` game.
+* `bulk` - the first peer sends large payloads with `send_bulk` to the
+others in turn.
+* `churn` - peers other than the first leave and new peers join.
+* `threads` - several threads send messages and stream packets through the
+same peers at once. Receivers check that the data of each thread arrives
+complete and in order, and the run exits with status 1 if it did not, or
+if sending raised exceptions.
+
+All peers share one process, so the numbers measure the cost of the
+library rather than the radio, and are only comparable when run on the same
+device with the same arguments.
+
+Other commands, given as the first argument:
+
+* `mesh` - times how long 2 to 8 peers take to connect every peer with
+every other peer, with each `invite_mode`. Use `--latency` to give the
+invitation round trips a cost.
+* `soak` - connects a new peer to a long-lived one and disconnects it
+again `--cycles` times, and fails if memory keeps growing or any
+registry of the multipeer module is left with entries.
+* `stripes` - compares the throughput of `send_bulk` with 1 to
+`MAX_STRIPES` streams and with the adaptive stripe count, on streams that
+each carry at most `--stream-rate` bytes per second.
+"""
+
+import argparse, ctypes, gc, heapq, itertools, random, struct, sys
+import threading, time, traceback, tracemalloc, weakref
+from ctypes import c_int, c_ulong, c_void_p
+
+from objc_util import ObjCClass, ObjCInstance, ns, c
+import multipeer
+
+NSStream = ObjCClass('NSStream')
+
+MIXES = ('chat', 'ticks', 'bulk', 'churn', 'threads')
+
+# Send timestamp and sequence number at the start of tick packets and bulk
+# payloads
+_stamp = struct.Struct('<dQ')
+# Send timestamp, producer thread and sequence number of the producer, for
+# the threads mix
+_producer_stamp = struct.Struct('<dIQ')
+
+
+# Loopback transport
+
+class _BlockDescriptor(ctypes.Structure):
+    _fields_ = [('reserved', c_ulong), ('size', c_ulong)]
+
+
+class _Block(ctypes.Structure):
+    _fields_ = [('isa', c_void_p), ('flags', c_int), ('reserved', c_int),
+                ('invoke', multipeer.InvokeFuncType),
+                ('descriptor', ctypes.POINTER(_BlockDescriptor))]
+
+_BLOCK_IS_GLOBAL = 1 << 28
+_global_block_class = ctypes.addressof(
+    c_void_p.in_dll(c, '_NSConcreteGlobalBlock'))
+_block_descriptor = _BlockDescriptor(0, ctypes.sizeof(_Block))
+
+
+class LoopbackNetwork():
+    """ Connects the loopback sessions, browsers and advertisers created
+    while it is installed. Framework callbacks are delivered in order on a
+    single thread, like the MC framework does, after `latency` seconds. If
+    `stream_rate` is set, each stream carries at most that many bytes per
+    second. """
+
+    def __init__(self, latency=0.0, stream_rate=None):
+        self.latency = latency
+        self.stream_rate = stream_rate
+        # Sessions by pointer, dropped once multipeer releases them
+        self.sessions = weakref.WeakValueDictionary()
+        self.browsers = []
+        self.advertisers = []
+        self.queue = []
+        self.invitations = 0
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def install(self):
+        """ Makes new `MultipeerConnectivity` objects use this network. """
+        self.originals = (multipeer.MCSession, multipeer.MCNearbyServiceBrowser,
+            multipeer.MCNearbyServiceAdvertiser)
+        multipeer.MCSession = _Factory(LoopbackSession, self)
+        multipeer.MCNearbyServiceBrowser = _Factory(LoopbackBrowser, self)
+        multipeer.MCNearbyServiceAdvertiser = _Factory(LoopbackAdvertiser, self)
+
+    def uninstall(self):
+        (multipeer.MCSession, multipeer.MCNearbyServiceBrowser,
+            multipeer.MCNearbyServiceAdvertiser) = self.originals
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def flush(self, timeout=10.0):
+        """ Waits until every callback queued so far, and the callbacks
+        they queued in turn, have been delivered. """
+        while True:
+            delivered = threading.Event()
+            self.call_later(delivered.set)
+            if not delivered.wait(timeout + self.latency):
+                raise TimeoutError('loopback network did not go idle')
+            with self.condition:
+                if len(self.queue) == 0:
+                    return
+
+    def call_later(self, func, *args):
+        self.call_at(time.perf_counter() + self.latency, func, *args)
+
+    def call_at(self, when, func, *args):
+        with self.condition:
+            heapq.heappush(self.queue, (when, next(self.order), func, args))
+            self.condition.notify()
+
+    def _deliver(self):
+        while True:
+            with self.condition:
+                while self.running and (len(self.queue) == 0 or
+                        self.queue[0][0] > time.perf_counter()):
+                    self.condition.wait(self.queue[0][0] - time.perf_counter()
+                        if len(self.queue) > 0 else None)
+                if not self.running:
+                    return
+                _, _, func, args = heapq.heappop(self.queue)
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def advertised(self, advertiser):
+        for browser in self.browsers:
+            self._found(browser, advertiser)
+
+    def browsing(self, browser):
+        for advertiser in self.advertisers:
+            self._found(browser, advertiser)
+
+    def _found(self, browser, advertiser):
+        if (browser.service_type == advertiser.service_type and
+                browser.peer_id.hash() != advertiser.peer_id.hash()):
+            self.call_later(multipeer.browser_foundPeer_withDiscoveryInfo_,
+                None, None, browser.ptr, _pointer(advertiser.peer_id),
+                advertiser.discovery_info)
+
+    def unadvertised(self, advertiser):
+        for browser in self.browsers:
+            if browser.service_type == advertiser.service_type:
+                self.call_later(multipeer.browser_lostPeer_, None, None,
+                    browser.ptr, _pointer(advertiser.peer_id))
+
+    def invite(self, session, peer_id, context):
+        self.invitations += 1
+        for advertiser in self.advertisers:
+            if advertiser.peer_id.hash() == peer_id.hash():
+                self.call_later(self._deliver_invite, session, advertiser,
+                    context)
+
+    def _deliver_invite(self, session, advertiser, context):
+        def handler(block, accept, invitee_session):
+            invitee = self.sessions.get(invitee_session, None)
+            if accept and invitee is not None:
+                self.connect(session, invitee)
+        block = _Block(_global_block_class, _BLOCK_IS_GLOBAL, 0,
+            multipeer.InvokeFuncType(handler), ctypes.pointer(_block_descriptor))
+        # The delegate calls the handler before returning
+        multipeer.\
+            advertiser_didReceiveInvitationFromPeer_withContext_invitationHandler_(
+                None, None, advertiser.ptr, _pointer(session.peer_id),
+                None if context is None else ns(context),
+                ctypes.addressof(block))
+
+    def connect(self, session, other):
+        if other in session.connected or session is other:
+            return
+        session.connected.append(other)
+        other.connected.append(session)
+        self.call_later(multipeer.session_peer_didChangeState_, None, None,
+            session.ptr, _pointer(other.peer_id), 2)
+        self.call_later(multipeer.session_peer_didChangeState_, None, None,
+            other.ptr, _pointer(session.peer_id), 2)
+
+    def disconnect(self, session):
+        for other in list(session.connected):
+            session.connected.remove(other)
+            other.connected.remove(session)
+            self.call_later(multipeer.session_peer_didChangeState_, None,
+                None, other.ptr, _pointer(session.peer_id), 0)
+            self.call_later(multipeer.session_peer_didChangeState_, None,
+                None, session.ptr, _pointer(other.peer_id), 0)
+
+    def send(self, session, data, peer_ids):
+        data = data if isinstance(data, ObjCInstance) else ns(bytes(data))
+        for peer_id in peer_ids:
+            other = self._connected_session(session, peer_id)
+            if other is not None:
+                self.call_later(self._deliver_data, session, other, data)
+
+    def _deliver_data(self, session, other, data):
+        if other in session.connected:
+            multipeer.session_didReceiveData_fromPeer_(None, None, other.ptr,
+                data, _pointer(session.peer_id))
+
+    def start_stream(self, session, name, peer_id):
+        input_stream, output_stream = _bound_streams()
+        if self.stream_rate is not None:
+            input_stream = _StreamRelay(self, input_stream,
+                self.stream_rate).input_stream
+        other = self._connected_session(session, peer_id)
+        if other is not None:
+            self.call_later(multipeer.session_didReceiveStream_withName_fromPeer_,
+                multipeer.SDelegate, None, other.ptr, input_stream, ns(name),
+                _pointer(session.peer_id))
+        return output_stream
+
+    def _connected_session(self, session, peer_id):
+        peer_hash = ObjCInstance(peer_id).hash()
+        for other in session.connected:
+            if other.peer_id.hash() == peer_hash:
+                return other
+        return None
+
+
+def _pointer(objc_object):
+    return multipeer._pointer(objc_object)
+
+
+def _bound_streams(size=65536):
+    """ Returns a connected pair of input and output streams. """
+    input_stream, output_stream = c_void_p(), c_void_p()
+    NSStream.getBoundStreamsWithBufferSize_inputStream_outputStream_(
+        size, ctypes.byref(input_stream), ctypes.byref(output_stream))
+    return ObjCInstance(input_stream), ObjCInstance(output_stream)
+
+
+class _StreamRelay():
+    """ Copies what is written to a stream over to `input_stream` at
+    most `rate` bytes per second, polling on the network thread, until the
+    writing side is closed. """
+
+    interval = 0.005
+
+    def __init__(self, network, source, rate):
+        self.network = network
+        self.source = source
+        self.rate = rate
+        self.input_stream, self.sink = _bound_streams()
+        self.pending = b''
+        self.allowance = 0.0
+        self.polled_at = time.perf_counter()
+        self.source.open()
+        self.sink.open()
+        network.call_at(self.polled_at + self.interval, self.poll)
+
+    def poll(self):
+        now = time.perf_counter()
+        # At most one interval of unused rate carries over
+        self.allowance = min(self.rate*self.interval,
+            self.allowance + self.rate*(now - self.polled_at))
+        self.polled_at = now
+        if len(self.pending) == 0 and self.allowance >= 1 and \
+                self.source.hasBytesAvailable():
+            size = min(65536, int(self.allowance))
+            buffer = ctypes.create_string_buffer(size)
+            read_len = self.source.read_maxLength_(buffer, size)
+            if read_len > 0:
+                self.pending = buffer[:read_len]
+                self.allowance -= read_len
+        if len(self.pending) > 0 and self.sink.hasSpaceAvailable():
+            wrote_len = self.sink.write_maxLength_(self.pending,
+                len(self.pending))
+            if wrote_len > 0:
+                self.pending = self.pending[wrote_len:]
+        # At end or closed
+        if self.source.streamStatus() >= 5 and len(self.pending) == 0:
+            self.source.close()
+            self.sink.close()
+            return
+        self.network.call_at(now + self.interval, self.poll)
+
+
+class _Factory():
+    """ Stands in for an MC framework class in `multipeer`. """
+
+    def __init__(self, loopback_class, network):
+        self.loopback_class = loopback_class
+        self.network = network
+
+    def alloc(self):
+        return self.loopback_class(self.network)
+
+
+class _Loopback():
+
+    _pointers = itertools.count(1)
+
+    def __init__(self, network):
+        self.network = network
+        self.ptr = next(self._pointers)
+        self._as_parameter_ = c_void_p(self.ptr)
+
+    def setDelegate_(self, delegate):
+        pass
+
+
+class LoopbackSession(_Loopback):
+
+    def initWithPeer_securityIdentity_encryptionPreference_(self, peer_id,
+            identity, encryption):
+        self.peer_id = peer_id
+        self.connected = []
+        self.network.sessions[self.ptr] = self
+        return self
+
+    def connectedPeers(self):
+        return [session.peer_id for session in self.connected]
+
+    # Bridge calls to the framework release the GIL, so these do too, to
+    # let other threads sending at the same time run in between
+    def sendData_toPeers_withMode_error_(self, data, peer_ids, mode, error):
+        time.sleep(0)
+        self.network.send(self, data, peer_ids)
+        return True
+
+    def startStreamWithName_toPeer_error_(self, name, peer_id, error):
+        time.sleep(0)
+        return self.network.start_stream(self, name, peer_id)
+
+    def disconnect(self):
+        self.network.disconnect(self)
+
+
+class LoopbackBrowser(_Loopback):
+
+    def initWithPeer_serviceType_(self, peer_id, service_type):
+        self.peer_id = peer_id
+        self.service_type = service_type
+        return self
+
+    def startBrowsingForPeers(self):
+        if self not in self.network.browsers:
+            self.network.browsers.append(self)
+            self.network.browsing(self)
+
+    def stopBrowsingForPeers(self):
+        if self in self.network.browsers:
+            self.network.browsers.remove(self)
+
+    def invitePeer_toSession_withContext_timeout_(self, peer_id, session,
+            context, timeout):
+        self.network.invite(session, peer_id, context)
+
+
+class LoopbackAdvertiser(_Loopback):
+
+    def initWithPeer_discoveryInfo_serviceType_(self, peer_id, discovery_info,
+            service_type):
+        self.peer_id = peer_id
+        self.discovery_info = discovery_info
+        self.service_type = service_type
+        return self
+
+    def startAdvertisingPeer(self):
+        if self not in self.network.advertisers:
+            self.network.advertisers.append(self)
+            self.network.advertised(self)
+
+    def stopAdvertisingPeer(self):
+        if self in self.network.advertisers:
+            self.network.advertisers.remove(self)
+            self.network.unadvertised(self)
+
+
+# Measurement
+
+class Stats():
+    """ Thread-safe counters and latency samples per traffic mix. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.bytes = {}
+        self.latencies = {}
+        self.events = {}
+
+    def received(self, mix, byte_count, sent_at):
+        latency = time.perf_counter() - sent_at
+        with self.lock:
+            self.messages[mix] = self.messages.get(mix, 0) + 1
+            self.bytes[mix] = self.bytes.get(mix, 0) + byte_count
+            self.latencies.setdefault(mix, []).append(latency)
+
+    def count(self, event):
+        with self.lock:
+            self.events[event] = self.events.get(event, 0) + 1
+
+    def report(self, duration):
+        print(f'{"mix":8}{"messages":>10}{"msg/s":>10}{"MB/s":>8}'
+            f'{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+        for mix in sorted(self.messages):
+            latencies = sorted(self.latencies[mix])
+            print(f'{mix:8}{self.messages[mix]:>10}'
+                f'{self.messages[mix]/duration:>10.0f}'
+                f'{self.bytes[mix]/duration/1e6:>8.2f}' +
+                ''.join(f'{percentile(latencies, p)*1000:>9.2f}'
+                    for p in (50, 90, 99, 100)))
+        for event in sorted(self.events):
+            print(f'{event}: {self.events[event]}')
+
+
+def percentile(sorted_values, p):
+    """ Returns the `p`th percentile of a sorted list, 0 for an empty one. """
+    if len(sorted_values) == 0:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values)*p/100))
+    return sorted_values[index]
+
+
+class LoadPeer(multipeer.MultipeerConnectivity):
+    """ Peer that records what it receives in `stats`. """
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        self.partial_ticks = {}
+        self.producer_seqs = {}
+        super().__init__(**kwargs)
+
+    def peer_added(self, peer_id):
+        self.stats.count('peers added')
+
+    def peer_removed(self, peer_id):
+        self.stats.count('peers removed')
+        peer_hash = peer_id.hash()
+        for key in [key for key in self.partial_ticks if key[0] == peer_hash]:
+            del self.partial_ticks[key]
+        for key in [key for key in self.producer_seqs
+                if key[0] == peer_hash]:
+            del self.producer_seqs[key]
+
+    def receive(self, message, from_peer):
+        if 'producer' in message:
+            self.check_order('message', message['producer'], message['seq'],
+                from_peer)
+            self.stats.received('threads', len(message['text']),
+                message['sent'])
+            return
+        self.stats.received('chat', len(message['text']), message['sent'])
+
+    def channel_receive(self, channel, byte_data, from_peer):
+        # Packets may be split between reads
+        record = _stamp if channel == 'ticks' else _producer_stamp
+        key = (from_peer.hash(), channel)
+        data = self.partial_ticks.pop(key, b'') + byte_data
+        end = len(data) - len(data) % record.size
+        for offset in range(0, end, record.size):
+            if channel == 'ticks':
+                sent_at, _ = _stamp.unpack_from(data, offset)
+                self.stats.received('ticks', _stamp.size, sent_at)
+            else:
+                sent_at, producer, seq = _producer_stamp.unpack_from(data,
+                    offset)
+                self.check_order('stream', producer, seq, from_peer)
+                self.stats.received('threads', _producer_stamp.size, sent_at)
+        if end < len(data):
+            self.partial_ticks[key] = data[end:]
+
+    def check_order(self, kind, producer, seq, from_peer):
+        """ Counts data from a producer thread that did not follow the
+        previous data from the same thread. The first data seen sets the
+        starting point, as peers join while the threads are running. """
+        key = (from_peer.hash(), kind, producer)
+        last = self.producer_seqs.get(key, None)
+        if last is not None and seq != last + 1:
+            self.stats.count(f'threads: {kind} out of order')
+        self.producer_seqs[key] = seq
+
+    def bulk_receive(self, byte_data, from_peer):
+        sent_at, _ = _stamp.unpack_from(byte_data)
+        self.stats.received('bulk', len(byte_data), sent_at)
+
+
+# Traffic mixes, each run on its own thread until `stop` is set
+
+def chat_traffic(peers, stop, rate=20, size=80):
+    count = 0
+    while not stop.wait(1/rate):
+        for peer in list(peers):
+            count += 1
+            peer.send({'text': 'x'*size, 'count': count,
+                'sent': time.perf_counter()})
+
+
+def tick_traffic(peers, stop, rate=30):
+    seq = 0
+    while not stop.wait(1/rate):
+        seq += 1
+        for peer in list(peers):
+            peer.stream(_stamp.pack(time.perf_counter(), seq), channel='ticks')
+
+
+def bulk_traffic(peers, stop, interval=1.0, size=1000000):
+    filler = bytes(size - _stamp.size)
+    seq = 0
+    while not stop.wait(interval):
+        sender = peers[0]
+        receivers = sender.get_peers()
+        if len(receivers) > 0:
+            seq += 1
+            sender.send_bulk(_stamp.pack(time.perf_counter(), seq) + filler,
+                receivers[seq % len(receivers)])
+
+
+def churn_traffic(peers, stop, make_peer, interval=2.0):
+    while not stop.wait(interval):
+        if len(peers) > 1:
+            leaving = peers.pop(random.randrange(1, len(peers)))
+            leaving.end_all()
+        if not stop.wait(interval/2):
+            peers.append(make_peer())
+
+
+def threaded_traffic(peers, stop, stats, threads=8, rate=100, size=40):
+    """ Runs `threads` producers that each send to all peers through
+    every peer, with `send` and `stream`, at once. """
+    def produce(producer):
+        seq = 0
+        while not stop.wait(1/rate):
+            seq += 1
+            for peer in list(peers):
+                try:
+                    sent = time.perf_counter()
+                    peer.send({'producer': producer, 'seq': seq,
+                        'text': 'x'*size, 'sent': sent})
+                    peer.stream(_producer_stamp.pack(sent, producer, seq),
+                        channel='producers')
+                except Exception:
+                    stats.count('threads: exceptions')
+                    traceback.print_exc()
+
+    producers = [threading.Thread(target=produce, args=(i,), daemon=True)
+        for i in range(threads)]
+    for thread in producers:
+        thread.start()
+    for thread in producers:
+        thread.join()
+
+
+def thread_failures(stats):
+    """ Returns the counts of the events of the threads mix that mean
+    that data of a producer thread arrived out of order or not at all, or
+    that sending raised an exception, keyed by event. """
+    with stats.lock:
+        return {event: count for event, count in stats.events.items()
+            if event.startswith('threads: ')}
+
+
+def run(peer_count=4, mixes=MIXES, duration=10.0, latency=0.0, warmup=2.0):
+    """ Runs the load test and prints the results. Returns the `Stats`. """
+    network = LoopbackNetwork(latency)
+    network.install()
+    stats = Stats()
+    names = itertools.count(1)
+
+    def make_peer():
+        return LoadPeer(stats, display_name=f'Load {next(names)}',
+            service_type='mc-load')
+
+    tracemalloc.start()
+    try:
+        peers = [make_peer() for _ in range(peer_count)]
+        time.sleep(warmup)
+        memory_before = tracemalloc.get_traced_memory()[0]
+        stop = threading.Event()
+        traffic = {
+            'chat': lambda: chat_traffic(peers, stop),
+            'ticks': lambda: tick_traffic(peers, stop),
+            'bulk': lambda: bulk_traffic(peers, stop),
+            'churn': lambda: churn_traffic(peers, stop, make_peer),
+            'threads': lambda: threaded_traffic(peers, stop, stats),
+        }
+        threads = [threading.Thread(target=traffic[mix], daemon=True)
+            for mix in mixes]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        for peer in peers:
+            peer.end_all()
+    finally:
+        tracemalloc.stop()
+        network.uninstall()
+
+    print(f'{peer_count} peers, {", ".join(mixes)}, {elapsed:.1f} s, '
+        f'{latency*1000:.1f} ms added latency')
+    stats.report(elapsed)
+    print(f'memory: {(memory_after - memory_before)/1e6:.2f} MB growth, '
+        f'{memory_peak/1e6:.2f} MB peak')
+    return stats
+
+
+# Benchmarks
+
+class MeshPeer(multipeer.MultipeerConnectivity):
+    """ Peer that sets `meshed` once it has added `expected` peers. """
+
+    def __init__(self, expected, **kwargs):
+        self.expected = expected
+        self.added = 0
+        self.meshed = threading.Event()
+        super().__init__(**kwargs)
+
+    def peer_added(self, peer_id):
+        self.added += 1
+        if self.added >= self.expected:
+            self.meshed.set()
+
+    def peer_removed(self, peer_id):
+        pass
+
+
+class SoakPeer(multipeer.MultipeerConnectivity):
+    """ Peer that counts the peers added and removed. """
+
+    def __init__(self, **kwargs):
+        self.added = 0
+        self.removed = 0
+        self.condition = threading.Condition()
+        super().__init__(**kwargs)
+
+    def peer_added(self, peer_id):
+        with self.condition:
+            self.added += 1
+            self.condition.notify_all()
+
+    def peer_removed(self, peer_id):
+        with self.condition:
+            self.removed += 1
+            self.condition.notify_all()
+
+    def wait_for(self, attribute, count, timeout):
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: getattr(self, attribute) >= count, timeout):
+                raise TimeoutError(f'{self.my_id.display_name}: {count} '
+                    f'peers not {attribute}')
+
+    def receive(self, message, from_peer):
+        pass
+
+    def stream_receive(self, byte_data, from_peer):
+        pass
+
+    def topic_receive(self, topic, message, from_peer):
+        pass
+
+
+# Registries of the multipeer module, and the maps a peer keeps per peer
+_MODULE_REGISTRIES = ('mc_managers', 'mc_inputstream_managers',
+    'mc_outputstream_managers')
+_PEER_MAPS = ('_peer_ids', 'peer_states', 'initial_peer_data',
+    '_handshaken_peers', 'outputstream_per_peer', 'pending_per_outputstream',
+    'inputstreams', '_heartbeats', '_rate_controllers')
+_TOPIC_MAPS = ('peer_ids', 'topics_per_peer', 'peers_per_topic',
+    'peers_per_pattern', 'targets')
+
+
+def _leftovers(owner, names, label):
+    """ Returns the `names` of the containers of `owner` that are not
+    empty, prefixed with `label`. """
+    return [label + name for name in names if len(getattr(owner, name)) > 0]
+
+
+def soak_churn(cycles=2000, warmup=100, max_growth=256*1024, timeout=10.0):
+    """ Connects a new peer to a long-lived one and disconnects it again
+    `cycles` times, with streams, subscriptions, heartbeats and rate
+    control in use. Raises AssertionError if the memory traced after the
+    `warmup` cycles grows by more than `max_growth` bytes, or if the
+    module registries or the per-peer maps of the long-lived peer keep
+    entries after the peers have left. Returns the growth in bytes. """
+    network = LoopbackNetwork()
+    network.install()
+    options = dict(service_type='mc-soak', initialize_streams=True,
+        heartbeat_interval=1.0, rate_control=True)
+    host = SoakPeer(display_name='Host', **options)
+    host.subscribe('soak')
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        for cycle in range(cycles):
+            if cycle == warmup:
+                network.flush(timeout)
+                gc.collect()
+                memory_before = tracemalloc.get_traced_memory()[0]
+            joining = SoakPeer(display_name=f'Churn {cycle}', **options)
+            joining.subscribe('soak')
+            host.wait_for('added', cycle + 1, timeout)
+            joining.wait_for('added', 1, timeout)
+            host.publish('soak', {'cycle': cycle})
+            joining.stream(b'x'*100)
+            joining.end_all()
+            host.wait_for('removed', cycle + 1, timeout)
+        elapsed = time.perf_counter() - started
+        network.flush(timeout)
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - memory_before
+        leftovers = _leftovers(host, _PEER_MAPS, 'host.') + _leftovers(
+            host._topic_index, _TOPIC_MAPS, 'host._topic_index.')
+        host.end_all()
+        network.flush(timeout)
+        leftovers += _leftovers(multipeer, _MODULE_REGISTRIES, 'multipeer.')
+    finally:
+        tracemalloc.stop()
+        host.end_all()
+        network.uninstall()
+    print(f'{cycles} connect/disconnect cycles, '
+        f'{elapsed/cycles*1000:.2f} ms per cycle, '
+        f'{growth/1e3:.1f} kB growth after {warmup} cycles')
+    assert len(leftovers) == 0, f'entries left in {", ".join(leftovers)}'
+    assert growth <= max_growth, \
+        f'memory grew by {growth} bytes over {cycles - warmup} cycles'
+    return growth
+
+
+class BulkPeer(multipeer.MultipeerConnectivity):
+    """ Peer that counts the peers added and the bulk payloads received. """
+
+    def __init__(self, **kwargs):
+        self.added = 0
+        self.received = 0
+        self.condition = threading.Condition()
+        super().__init__(**kwargs)
+
+    def peer_added(self, peer_id):
+        with self.condition:
+            self.added += 1
+            self.condition.notify_all()
+
+    def peer_removed(self, peer_id):
+        pass
+
+    def bulk_receive(self, byte_data, from_peer):
+        with self.condition:
+            self.received += 1
+            self.condition.notify_all()
+
+    def wait_for(self, attribute, count, timeout):
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: getattr(self, attribute) >= count, timeout):
+                raise TimeoutError(f'{self.my_id.display_name}: {count} '
+                    f'not {attribute}')
+
+
+def benchmark_striping(stream_rate=2e6, size=500000, transfers=6,
+        stripe_counts=None, timeout=60.0):
+    """ Sends `transfers` payloads of `size` bytes one after the other
+    with `send_bulk` between two peers, on a loopback network where every
+    stream carries at most `stream_rate` bytes per second, with each of
+    the `stripe_counts`. None in `stripe_counts` lets `send_bulk` choose
+    the count from the throughput of the earlier transfers. Prints the
+    throughput and returns it as a dict of bytes per second keyed by the
+    stripe count. """
+    if stripe_counts is None:
+        stripe_counts = tuple(range(1, multipeer.MAX_STRIPES + 1)) + (None,)
+    payload = bytes(size)
+    results = {}
+    print(f'{transfers} transfers of {size/1e6:.2f} MB, '
+        f'{stream_rate/1e6:.2f} MB/s per stream')
+    for stripes in stripe_counts:
+        network = LoopbackNetwork(stream_rate=stream_rate)
+        network.install()
+        peers = []
+        try:
+            peers = [BulkPeer(display_name=f'Bulk {i + 1}',
+                service_type='mc-stripes') for i in range(2)]
+            sender, receiver = peers
+            sender.wait_for('added', 1, timeout)
+            receiver.wait_for('added', 1, timeout)
+            to_peer = sender.get_peers()[0]
+            started = time.perf_counter()
+            for transfer in range(transfers):
+                sender.send_bulk(payload, to_peer, stripes)
+                receiver.wait_for('received', transfer + 1, timeout)
+            elapsed = time.perf_counter() - started
+            chosen = sender._stripe_counts.get(to_peer.hash(), 1)
+        finally:
+            for peer in peers:
+                peer.end_all()
+            network.uninstall()
+        results[stripes] = transfers*size/elapsed
+        label = f'{stripes} stripes' if stripes is not None else \
+            f'adaptive, {chosen} stripes at the end'
+        print(f'{label}: {results[stripes]/1e6:.2f} MB/s')
+    return results
+
+
+def benchmark_mesh(peer_counts=range(2, 9), invite_modes=('mutual', 'single'),
+        latency=0.005, repeats=5, timeout=30.0):
+    """ Starts `peer_counts` peers at once with each of the
+    `invite_modes` and times how long it takes until every peer has added
+    every other peer. Prints the median time and the invitations sent, and
+    returns them as a dict of (time, invitations) tuples keyed by (mode,
+    peer count). """
+    results = {}
+    print(f'{"peers":>5}' + ''.join(f'{mode + " ms":>13}{"invites":>9}'
+        for mode in invite_modes))
+    for peer_count in peer_counts:
+        line = f'{peer_count:>5}'
+        for mode in invite_modes:
+            times, invitations = [], []
+            for _ in range(repeats):
+                network = LoopbackNetwork(latency)
+                network.install()
+                peers = []
+                try:
+                    started = time.perf_counter()
+                    peers = [MeshPeer(peer_count - 1,
+                        display_name=f'Mesh {i + 1}', service_type='mc-mesh',
+                        invite_mode=mode) for i in range(peer_count)]
+                    for peer in peers:
+                        if not peer.meshed.wait(
+                                started + timeout - time.perf_counter()):
+                            raise TimeoutError(
+                                f'{peer_count} peers did not connect with '
+                                f'{mode} invites')
+                    times.append(time.perf_counter() - started)
+                    invitations.append(network.invitations)
+                finally:
+                    for peer in peers:
+                        peer.end_all()
+                    network.uninstall()
+            times.sort()
+            result = (times[len(times)//2], max(invitations))
+            results[(mode, peer_count)] = result
+            line += f'{result[0]*1000:>13.1f}{result[1]:>9}'
+        print(line)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run scripted traffic between in-process multipeer peers.')
+    parser.add_argument('command', nargs='?', default='load',
+        choices=('load', 'mesh', 'soak', 'stripes'),
+        help='load test, time to connect all peers with each invite mode, '
+        'connect/disconnect soak test, or bulk throughput per stripe count')
+    parser.add_argument('--peers', type=int, default=4,
+        help='number of peers at the start')
+    parser.add_argument('--mix', default=','.join(MIXES),
+        help='comma-separated traffic mixes: ' + ', '.join(MIXES))
+    parser.add_argument('--duration', type=float, default=10.0,
+        help='seconds of traffic')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds added to every delivery')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the churn')
+    parser.add_argument('--cycles', type=int, default=2000,
+        help='connect/disconnect cycles of the soak test')
+    parser.add_argument('--stream-rate', type=float, default=2e6,
+        help='bytes per second each stream carries in the stripes test')
+    options = parser.parse_args(args)
+    mixes = [mix for mix in options.mix.split(',') if mix]
+    for mix in mixes:
+        if mix not in MIXES:
+            parser.error(f'unknown mix {mix}')
+    random.seed(options.seed)
+    if options.command == 'mesh':
+        benchmark_mesh(latency=options.latency)
+    elif options.command == 'soak':
+        soak_churn(options.cycles)
+    elif options.command == 'stripes':
+        benchmark_striping(options.stream_rate)
+    else:
+        stats = run(options.peers, mixes, options.duration, options.latency)
+        failures = thread_failures(stats)
+        if len(failures) > 0:
+            print('threads mix failed: ' + ', '.join(
+                f'{event[len("threads: "):]} {count}'
+                for event, count in sorted(failures.items())))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()